@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+#coding:utf-8
+"""
+Benchmark of microstates.segment on synthetic EEG with known microstates.
+
+Each configuration is varied one parameter at a time around a base setting, and
+is run in a fresh process so that its peak memory use can be measured. For each
+run, the wall time, the number of k-means iterations, the peak resident memory,
+the GEV and the agreement with the ground truth are saved to a JSON file. With
+--n-jobs above 1, the peak memory is that of the largest of the processes,
+which run at the same time, so it is not comparable across values of --n-jobs.
+Two such files, for example of two revisions, can be compared.
+
+Usage:
+    python bench_segment.py [--preset quick|full] [--out results.json]
+    python bench_segment.py --compare old.json new.json
+"""
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from microstates import segment
+from simulation import simulate_microstates
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# The setting around which each parameter is varied
+BASE = dict(n_channels=19, n_samples=100000, n_states=4, n_inits=10,
+            max_n_peaks=10000, n_components=None, method='kmeans',
+            init='random', prune=None)
+
+# The values taken by each parameter
+SWEEPS = {
+    'quick': dict(n_channels=[19, 64],
+                  n_samples=[10000, 100000],
+                  n_states=[3, 4, 8],
+                  n_inits=[1, 10],
+                  max_n_peaks=[1000, 10000],
+                  n_components=[None, 0.99],
+                  method=['kmeans', 'aahc'],
+                  init=['random', 'k-means++'],
+                  prune=[None, 0.01]),
+    'full': dict(n_channels=[19, 32, 64, 128, 256],
+                 n_samples=[10000, 100000, 1000000, 10000000],
+                 n_states=[3, 4, 6, 8, 10, 12],
+                 n_inits=[1, 5, 10, 20, 50],
+                 max_n_peaks=[1000, 10000, 100000, None],
+                 n_components=[None, 10, 0.95, 0.99],
+                 method=['kmeans', 'aahc'],
+                 init=['random', 'k-means++'],
+                 prune=[None, 0.001, 0.01, 0.05]),
+}
+
+PARAMS = ['n_channels', 'n_samples', 'n_states', 'n_inits', 'max_n_peaks',
+          'n_components', 'method', 'init', 'prune']
+
+
+#----------------------------------------------------------------------
+def configurations(preset):
+    """
+    The configurations of a preset: the base setting, with one parameter
+    changed at a time.
+    """
+    configs = [dict(BASE)]
+    for param, values in SWEEPS[preset].items():
+        for value in values:
+            config = dict(BASE, **{param: value})
+            if config not in configs:
+                configs.append(config)
+    return configs
+
+
+#----------------------------------------------------------------------
+def match_states(true_maps, maps):
+    """
+    Pair the found maps with the true maps, maximizing the absolute spatial
+    correlation. Returns for each found map the index of its true map, and
+    the absolute correlation of each pair.
+    """
+    true_maps = true_maps - true_maps.mean(axis=1, keepdims=True)
+    maps = maps - maps.mean(axis=1, keepdims=True)
+    corr = np.abs(maps.dot(true_maps.T))
+    corr /= np.outer(np.linalg.norm(maps, axis=1),
+                     np.linalg.norm(true_maps, axis=1))
+    found, true = linear_sum_assignment(-corr)
+    mapping = np.full(len(maps), -1)
+    mapping[found] = true
+    return mapping, corr[found, true]
+
+
+#----------------------------------------------------------------------
+def measure(config, seed, n_jobs):
+    """
+    Run segment on synthetic data once. Meant to run in a fresh process.
+    """
+    data, true_maps, true_labels = simulate_microstates(
+        config['n_channels'], config['n_samples'], config['n_states'],
+        random_state=seed)
+
+    start = time.perf_counter()
+    maps, segmentation, gev, n_iter = segment(
+        data, n_states=config['n_states'], n_inits=config['n_inits'],
+        max_n_peaks=config['max_n_peaks'],
+        n_components=config['n_components'], method=config['method'],
+        init=config['init'],
+        prune=config['prune'], n_jobs=n_jobs, return_gev=True,
+        return_n_iter=True, random_state=seed, verbose=False)
+    wall_time = time.perf_counter() - start
+
+    mapping, map_corr = match_states(true_maps, maps)
+    accuracy = np.mean(mapping[segmentation] == true_labels)
+
+    peak_rss = np.nan
+    if resource is not None:
+        # With n_jobs > 1 the fits run in the pool workers, which have exited
+        # by now. This is the peak of the largest process, not their total.
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        # Kilobytes on Linux, bytes on macOS
+        peak_rss /= 1024. ** 2 if platform.system() == 'Darwin' else 1024.
+
+    return dict(config, seed=seed, n_jobs=n_jobs, time=wall_time,
+                n_iter=int(n_iter), peak_rss_mb=peak_rss,
+                data_mb=data.nbytes / 1024. ** 2, gev=float(gev),
+                accuracy=float(accuracy), map_corr=float(np.mean(map_corr)))
+
+
+#----------------------------------------------------------------------
+def revision():
+    """
+    The git revision of the code, if available.
+    """
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.DEVNULL)
+        return output.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+#----------------------------------------------------------------------
+def run(preset='quick', repeats=3, n_jobs=1, out=None):
+    """
+    Run all configurations of a preset and save the results.
+    """
+    context = mp.get_context('spawn')
+    results = []
+    for config in configurations(preset):
+        for seed in range(repeats):
+            # A fresh process per run, so the peak memory is its own
+            with ProcessPoolExecutor(max_workers=1,
+                                     mp_context=context) as executor:
+                result = executor.submit(measure, config, seed,
+                                         n_jobs).result()
+            print('%s seed=%d: %.3f s, %d iterations, %.0f MB, GEV %.3f, '
+                  'accuracy %.3f'
+                  % (', '.join('%s=%s' % (p, config[p]) for p in PARAMS),
+                     seed, result['time'], result['n_iter'],
+                     result['peak_rss_mb'], result['gev'],
+                     result['accuracy']))
+            results.append(result)
+
+    info = dict(revision=revision(), date=datetime.datetime.now().isoformat(),
+                preset=preset, numpy=np.__version__,
+                python=platform.python_version(),
+                machine=platform.platform(), cpu_count=mp.cpu_count())
+    if out is not None:
+        with open(out, 'w') as f:
+            json.dump(dict(info=info, results=results), f, indent=1)
+        print('Results saved to %s' % out)
+    return results
+
+
+#----------------------------------------------------------------------
+def compare(old_file, new_file):
+    """
+    Compare the median wall time and mean GEV of the configurations run in
+    two benchmark files.
+    """
+    def load(fname):
+        with open(fname) as f:
+            results = json.load(f)['results']
+        grouped = dict()
+        for result in results:
+            # Files of older revisions may lack the newer parameters
+            key = (tuple(result.get(p, BASE[p]) for p in PARAMS) +
+                   (result['n_jobs'],))
+            grouped.setdefault(key, []).append(result)
+        return grouped
+
+    old, new = load(old_file), load(new_file)
+    print('%-45s %10s %10s %7s %9s' % ('configuration', 'old [s]', 'new [s]',
+                                       'speedup', 'dGEV'))
+    for key in old:
+        if key not in new:
+            continue
+        old_time = np.median([r['time'] for r in old[key]])
+        new_time = np.median([r['time'] for r in new[key]])
+        d_gev = (np.mean([r['gev'] for r in new[key]]) -
+                 np.mean([r['gev'] for r in old[key]]))
+        name = ' '.join('%s' % v for v in key)
+        print('%-45s %10.3f %10.3f %6.2fx %+9.4f' % (name, old_time, new_time,
+                                                   old_time / new_time, d_gev))
+
+
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark microstates.segment.')
+    parser.add_argument('--preset', choices=sorted(SWEEPS), default='quick')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--out', default='bench_segment.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args.preset, args.repeats, args.n_jobs, args.out)
@@ -14,6 +14,24 @@ TRIGGER_FILE =  r'C:\Users\brainhacker\git\NeuroDecode\neurodecode\triggers\trig
 STREAMBUFFER = 2                   	# Stream buffer [sec]
 WINDOWSIZE = 2                     	# window length of acquired data when calling get_window [sec]
 
+REPLAY_FILE = None                  # BrainVision .vhdr file to replay instead of the amplifier, None: live stream
+REPLAY_SPEED = 1.0                  # Playback speed relative to real time, None: as fast as possible
+REPLAY_JITTER = 0                   # Maximum random delay of each replayed chunk [sec]
+REPLAY_DROP_RATE = 0                # Probability of dropping each replayed chunk
+
+TEMPLATE_FILE = r'C:\Users\brainhacker\Desktop\ms_template.npz'   # Written by the trainer
+MICRO2REGULATE = 0                  # Index of the microstate template to regulate
+MIN_PEAK_DIST = 2                   # Minimum distance between GFP peaks [samples]
+PEAK_LOOKAHEAD = None               # Delay before confirming a GFP peak [samples], None: 3 * MIN_PEAK_DIST
+MIN_SEGMENT_MS = None               # Microstate segments shorter than this are merged into their neighbours [ms], None: no smoothing
+
+HOP_MS = 50                         # Time between feedback updates [ms], None: update as fast as data arrives
+FEEDBACK_WINDOW = 1                 # Trailing window the feedback is computed over [sec], None: WINDOWSIZE
+FEEDBACK_METRIC = 'coverage'        # Feedback on the 'coverage', 'mean_duration' or 'occurrence' of MICRO2REGULATE
+FEEDBACK_MAX = None                 # Value of the metric shown as 100% [sec or per sec], not needed for coverage
+FPS = 60                            # Frame rate of the feedback display
+LATENCY_FILE = None                 # CSV trace of the latency of each update, None: only log the summary
+
 GLOBAL_TIME = 5*60					# [secs]
 TIMER_SLEEP = 0.25*60				# [secs]
 
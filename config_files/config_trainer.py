@@ -12,10 +12,24 @@ EPOCH = []
 TRIGGER_FILE = r'C:\Users\brainhacker\git\NeuroDecode\neurodecode\triggers\triggerdef_16'
 TRIGGER_DEF = ['INIT']
 
+#-------------------------------------------
+# Microstates
+#-------------------------------------------
+N_STATES = 4                               # Number of microstates, or a list (e.g. range(2, 13)) to choose from
+NJOBS = 8                                  # For parallel k-means initializations
+MAX_N_PEAKS = 10000000                     # Maximum number of GFP peaks to cluster
+N_COMPONENTS = None                        # Cluster on principal components: a number, a fraction of variance (e.g. 0.99) or None
+METHOD = 'kmeans'                          # Clustering: 'kmeans' or 'aahc' (deterministic single run, for up to ~10000 peaks)
+INIT = 'random'                            # Initial maps of k-means: 'random' or 'k-means++' (fewer iterations)
+PRUNE = None                               # Abandon k-means initializations that stay this far below the best (e.g. 0.01), or None
+
+STREAMING = False                          # Read the recording in blocks, keeping only the GFP peaks
+CHUNK_SIZE = 10000                         # Block length [samples] in streaming mode
+
 
 
 #-------------------------------------------
 # Results
 #-------------------------------------------
-OUT_MICROSTATES_FILE = r'C:\Users\brainhacker\Desktop\ms_template.txt'
+OUT_MICROSTATES_FILE = r'C:\Users\brainhacker\Desktop\ms_template.npz'
 
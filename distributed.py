@@ -0,0 +1,491 @@
+"""
+Modified K-means on data that is split over files, processes or machines.
+
+One iteration of the modified K-means only needs, for each microstate, the
+sum of the topographies assigned to it weighted by their activation, and a
+few totals to check the convergence. These sums are computed on each shard
+of the data separately, as a :class:`KMeansStats`, and then added up, which
+gives exactly the update of a fit on all the data at once. Only the maps and
+the sums, of size (n_states, n_channels), are exchanged.
+
+:func:`fit_shards` runs the whole algorithm with a pool of local processes.
+To spread the shards over machines with a shared filesystem instead, run
+:func:`run_worker` on each machine and :func:`fit_exchange` on one of them:
+they exchange the maps and the sums through ``.npy`` and ``.npz`` files in a
+shared directory.
+"""
+import glob
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from mne.utils import logger, verbose
+
+from microstates import (normalize_templates, _iter_chunks, _n_samples,
+                         _take_samples)
+
+
+class KMeansStats(object):
+    """The sums needed for an iteration of the modified K-means.
+
+    The statistics of several shards of the data are merged by adding them
+    with ``+``. The merged statistics are the same as those of all the data
+    at once, up to rounding.
+
+    Parameters
+    ----------
+    n_states : int
+        The number of microstates.
+    n_channels : int
+        The number of channels.
+
+    Attributes
+    ----------
+    n_samples : int
+        The number of samples.
+    counts : ndarray of int, shape (n_states,)
+        The number of samples assigned to each microstate.
+    sums : ndarray, shape (n_states, n_channels)
+        For each microstate, the sum of the samples assigned to it, weighted
+        by their activation. Normalized, these are the updated maps.
+    act_sum_sq : float
+        The sum of the squared activations of the assigned microstates.
+    data_sum_sq : float
+        The sum of the squared samples.
+    explained : float
+        The sum of the squared activations of the assigned microstates, with
+        the samples and maps centered across channels.
+    total : float
+        The sum of the squared samples, centered across channels. The GEV is
+        ``explained / total``.
+    """
+    _fields = ('n_samples', 'counts', 'sums', 'act_sum_sq', 'data_sum_sq',
+               'explained', 'total')
+
+    def __init__(self, n_states, n_channels):
+        self.n_samples = 0
+        self.counts = np.zeros(n_states, dtype=int)
+        self.sums = np.zeros((n_states, n_channels))
+        self.act_sum_sq = 0.
+        self.data_sum_sq = 0.
+        self.explained = 0.
+        self.total = 0.
+
+    def __repr__(self):
+        return '<KMeansStats | %d states, %d channels, %d samples>' % (
+            self.sums.shape + (self.n_samples,))
+
+    def __add__(self, other):
+        merged = KMeansStats(*self.sums.shape)
+        for field in self._fields:
+            setattr(merged, field,
+                    getattr(self, field) + getattr(other, field))
+        return merged
+
+    def update(self, data, maps):
+        """Add samples, assigned to the best matching maps.
+
+        Parameters
+        ----------
+        data : ndarray, shape (n_channels, n_samples)
+            The samples.
+        maps : ndarray, shape (n_states, n_channels)
+            The current maps, normalized to unit length.
+        """
+        n_channels, n_samples = data.shape
+        samples = np.arange(n_samples)
+        activation = maps.dot(data)
+        labels = np.argmax(np.abs(activation), axis=0)
+        assigned = activation[labels, samples]
+        self.n_samples += n_samples
+        self.counts += np.bincount(labels, minlength=len(maps))
+
+        # The weighted sums are a single product with a one-hot matrix
+        # holding the activations, as in microstates._mod_kmeans. scipy
+        # computes it on the transposed data, which has to be contiguous.
+        assignment = csr_matrix((assigned, labels, np.arange(n_samples + 1)),
+                                shape=(n_samples, len(maps)))
+        self.sums += assignment.T @ np.ascontiguousarray(data.T)
+        self.act_sum_sq += np.sum(assigned ** 2)
+        data_sq = np.sum(data ** 2)
+        self.data_sum_sq += data_sq
+
+        # The GEV uses the maps and samples centered across channels. The
+        # centered maps sum to zero, so their activations do not change when
+        # the samples are centered too. Maps that were never activated are
+        # zero, and are never assigned.
+        with np.errstate(invalid='ignore'):
+            centered_maps = normalize_templates(maps)
+        centered_act = centered_maps.dot(data)[labels, samples]
+        self.explained += np.sum(centered_act ** 2)
+        self.total += data_sq - n_channels * np.sum(np.mean(data, axis=0) ** 2)
+
+    @property
+    def residual(self):
+        """The variance of the residual noise, used to check convergence."""
+        n_channels = self.sums.shape[1]
+        return (abs(self.data_sum_sq - self.act_sum_sq) /
+                float(self.n_samples * (n_channels - 1)))
+
+    @property
+    def gev(self):
+        """The global explained variance (GEV) of the maps."""
+        return self.explained / self.total
+
+    def save(self, fname):
+        """Save the statistics to a binary .npz file.
+
+        The file is first written under a temporary name and then renamed,
+        so that a process waiting for it never reads it half written.
+
+        Parameters
+        ----------
+        fname : str
+            The name of the file, which should end in ``.npz``.
+        """
+        tmp_fname = fname + '.tmp'
+        with open(tmp_fname, 'wb') as f:
+            np.savez(f, **dict((field, getattr(self, field))
+                               for field in self._fields))
+        os.replace(tmp_fname, fname)
+
+
+def read_kmeans_stats(fname):
+    """Read the statistics written by :meth:`KMeansStats.save`.
+
+    Parameters
+    ----------
+    fname : str
+        The name of the ``.npz`` file.
+
+    Returns
+    -------
+    stats : instance of KMeansStats
+        The statistics.
+    """
+    with np.load(fname, allow_pickle=False) as f:
+        stats = KMeansStats(*f['sums'].shape)
+        for field in KMeansStats._fields:
+            value = f[field]
+            setattr(stats, field, value if value.ndim else value.item())
+    return stats
+
+
+def shard_stats(shards, maps, chunk_size=None):
+    """Compute the statistics of shards of the data for the given maps.
+
+    Parameters
+    ----------
+    shards : list of (ndarray | str)
+        The shards, each the topographies to cluster as an ndarray of shape
+        (n_channels, n_samples), for example the GFP peaks of one recording,
+        or the name of a ``.npy`` file holding them, which is
+        memory-mapped.
+    maps : ndarray, shape (n_states, n_channels)
+        The current maps, normalized to unit length.
+    chunk_size : int | None
+        The number of samples to process at a time. Defaults to ``None``,
+        in which case each shard is processed at once.
+
+    Returns
+    -------
+    stats : instance of KMeansStats
+        The statistics of all given shards together.
+    """
+    stats = KMeansStats(*maps.shape)
+    for shard in shards:
+        for _, block in _iter_chunks(_open_shard(shard), chunk_size):
+            stats.update(block, maps)
+    return stats
+
+
+def init_maps(shards, n_states, random_state=None):
+    """Choose initial maps among the samples of all shards.
+
+    Like the random initialization of :func:`microstates.segment`, distinct
+    samples are chosen uniformly.
+
+    Parameters
+    ----------
+    shards : list of (ndarray | str)
+        The shards. See :func:`shard_stats`.
+    n_states : int
+        The number of microstates.
+    random_state : int | numpy.random.RandomState | None
+        The seed or ``RandomState`` for the random number generator.
+        Defaults to ``None``.
+
+    Returns
+    -------
+    maps : ndarray, shape (n_states, n_channels)
+        The initial maps, normalized to unit length.
+    """
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+    shards = [_open_shard(shard) for shard in shards]
+    offsets = np.cumsum([0] + [_n_samples(shard) for shard in shards])
+    samples = np.sort(random_state.choice(offsets[-1], size=n_states,
+                                          replace=False))
+    maps = []
+    for shard, start, stop in zip(shards, offsets[:-1], offsets[1:]):
+        in_shard = samples[(samples >= start) & (samples < stop)] - start
+        if len(in_shard) > 0:
+            maps.append(_take_samples(shard, in_shard).T)
+    maps = np.vstack(maps)
+    return maps / np.linalg.norm(maps, axis=1, keepdims=True)
+
+
+@verbose
+def fit_shards(shards, n_states=4, maps=None, max_iter=1000, thresh=1e-6,
+               n_jobs=1, chunk_size=None, random_state=None, verbose=None):
+    """Fit the modified K-means on data split in shards, in local processes.
+
+    At each iteration, the shards are spread over ``n_jobs`` processes,
+    which each compute the statistics of their shards. Only the maps and
+    the statistics are sent between the processes, so the shards are best
+    given as file names.
+
+    Parameters
+    ----------
+    shards : list of (ndarray | str)
+        The shards. See :func:`shard_stats`.
+    n_states : int
+        The number of microstates. Defaults to 4.
+    maps : ndarray, shape (n_states, n_channels) | None
+        The initial maps. Defaults to ``None``, in which case they are
+        chosen with :func:`init_maps`.
+    max_iter : int
+        The maximum number of iterations. Defaults to 1000.
+    thresh : float
+        The threshold of convergence, based on the relative change in noise
+        variance. Defaults to 1e-6.
+    n_jobs : int
+        The number of processes. Set to ``-1`` to use all CPU cores.
+        Defaults to 1.
+    chunk_size : int | None
+        The number of samples to process at a time in each shard. Defaults
+        to ``None``.
+    random_state : int | numpy.random.RandomState | None
+        The seed or ``RandomState`` for the initial maps. Defaults to
+        ``None``.
+    verbose : int | bool | None
+        Controls the verbosity.
+
+    Returns
+    -------
+    maps : ndarray, shape (n_states, n_channels)
+        The topographic maps of the microstates.
+    gev : float
+        The global explained variance of the maps on all shards.
+    n_iter : int
+        The number of iterations performed.
+    """
+    if maps is None:
+        maps = init_maps(shards, n_states, random_state)
+    if n_jobs < 0:
+        n_jobs = mp.cpu_count()
+    n_jobs = min(n_jobs, len(shards))
+    logger.info('Fitting %d microstates on %d shards over %d processes' %
+                (len(maps), len(shards), n_jobs))
+    batches = [list(batch) for batch in np.array_split(
+        np.arange(len(shards)), n_jobs)]
+    batches = [[shards[i] for i in batch] for batch in batches]
+
+    if n_jobs == 1:
+        def compute_stats(maps, iteration):
+            return shard_stats(shards, maps, chunk_size)
+        return _fit_loop(compute_stats, maps, max_iter, thresh)
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        def compute_stats(maps, iteration):
+            futures = [executor.submit(shard_stats, batch, maps, chunk_size)
+                       for batch in batches]
+            return sum((future.result() for future in futures[1:]),
+                       futures[0].result())
+        return _fit_loop(compute_stats, maps, max_iter, thresh)
+
+
+@verbose
+def fit_exchange(exchange_dir, n_workers, maps, max_iter=1000, thresh=1e-6,
+                 poll_interval=1., timeout=None, verbose=None):
+    """Fit the modified K-means with workers that exchange files.
+
+    The maps of each iteration are written to ``exchange_dir``, and the
+    statistics of the workers, started with :func:`run_worker` on any
+    machine that shares the directory, are read back and merged. The
+    directory holds, for each iteration ``i`` (written on five digits):
+
+    - ``maps_<i>.npy``, the maps, written by this function;
+    - ``stats_<i>_<worker>.npz``, the statistics of each worker, written by
+      :func:`run_worker` and readable with :func:`read_kmeans_stats`.
+
+    When the fit is done, the final maps are written to ``maps_final.npy``,
+    which stops the workers. Files are written under a temporary name and
+    then renamed, so they are never read half written.
+
+    Parameters
+    ----------
+    exchange_dir : str
+        The shared directory, which should be empty.
+    n_workers : int
+        The number of workers to wait for at each iteration.
+    maps : ndarray, shape (n_states, n_channels)
+        The initial maps, for example from :func:`init_maps`.
+    max_iter : int
+        The maximum number of iterations. Defaults to 1000.
+    thresh : float
+        The threshold of convergence. Defaults to 1e-6.
+    poll_interval : float
+        The time in seconds between two checks for the files of the
+        workers. Defaults to 1.
+    timeout : float | None
+        The maximum time in seconds to wait for the workers at each
+        iteration. Defaults to ``None``, in which case there is no limit.
+    verbose : int | bool | None
+        Controls the verbosity.
+
+    Returns
+    -------
+    maps : ndarray, shape (n_states, n_channels)
+        The topographic maps of the microstates.
+    gev : float
+        The global explained variance of the maps on all shards.
+    n_iter : int
+        The number of iterations performed.
+    """
+    if not os.path.isdir(exchange_dir):
+        os.makedirs(exchange_dir)
+    if glob.glob(os.path.join(exchange_dir, 'maps_*.npy')):
+        raise ValueError('The exchange directory %s is not empty.'
+                         % exchange_dir)
+    logger.info('Fitting %d microstates with %d workers through %s' %
+                (len(maps), n_workers, exchange_dir))
+
+    def compute_stats(maps, iteration):
+        _save_array(_maps_fname(exchange_dir, iteration), maps)
+        pattern = os.path.join(exchange_dir, 'stats_%05d_*.npz' % iteration)
+        fnames = _wait_for(lambda: sorted(glob.glob(pattern)),
+                           lambda fnames: len(fnames) >= n_workers,
+                           poll_interval, timeout)
+        stats = [read_kmeans_stats(fname) for fname in fnames]
+        return sum(stats[1:], stats[0])
+
+    maps, gev, n_iter = _fit_loop(compute_stats, maps, max_iter, thresh)
+    _save_array(_maps_fname(exchange_dir, 'final'), maps)
+    return maps, gev, n_iter
+
+
+@verbose
+def run_worker(shards, exchange_dir, worker, chunk_size=None,
+               poll_interval=1., timeout=None, verbose=None):
+    """Compute the statistics of shards for a fit with :func:`fit_exchange`.
+
+    For each iteration, waits for the maps in ``exchange_dir``, computes the
+    statistics of the given shards and writes them next to the maps. Stops
+    when the final maps are written.
+
+    Parameters
+    ----------
+    shards : list of (ndarray | str)
+        The shards of this worker. See :func:`shard_stats`. Each shard
+        should be given to a single worker.
+    exchange_dir : str
+        The shared directory, as given to :func:`fit_exchange`.
+    worker : str
+        The name of this worker, unique among the workers, for example the
+        host name.
+    chunk_size : int | None
+        The number of samples to process at a time in each shard. Defaults
+        to ``None``.
+    poll_interval : float
+        The time in seconds between two checks for the maps. Defaults to 1.
+    timeout : float | None
+        The maximum time in seconds to wait for the maps of an iteration.
+        Defaults to ``None``, in which case there is no limit.
+    verbose : int | bool | None
+        Controls the verbosity.
+    """
+    final = _maps_fname(exchange_dir, 'final')
+    iteration = 0
+    while True:
+        fname = _maps_fname(exchange_dir, iteration)
+        _wait_for(lambda: os.path.exists(fname) or os.path.exists(final),
+                  bool, poll_interval, timeout)
+        if not os.path.exists(fname):
+            logger.info('Worker %s stops after %d iterations.' %
+                        (worker, iteration))
+            return
+        stats = shard_stats(shards, np.load(fname), chunk_size)
+        stats.save(os.path.join(exchange_dir, 'stats_%05d_%s.npz'
+                                % (iteration, worker)))
+        iteration += 1
+
+
+def _fit_loop(compute_stats, maps, max_iter, thresh):
+    """The iterations of the modified K-means, given a way to get the sums.
+
+    ``compute_stats(maps, iteration)`` returns the merged statistics of all
+    shards for the maps. The update and the convergence check are those of
+    :func:`microstates._mod_kmeans`.
+    """
+    maps = np.array(maps, dtype=float)
+    prev_residual = np.inf
+    for iteration in range(max_iter):
+        stats = compute_stats(maps, iteration)
+        residual = stats.residual
+        if prev_residual - residual < thresh * residual:
+            logger.info('Converged at %d iterations, GEV %f' %
+                        (iteration, stats.gev))
+            return maps, stats.gev, iteration + 1
+        prev_residual = residual
+        if iteration == max_iter - 1:
+            break
+
+        norms = np.linalg.norm(stats.sums, axis=1, keepdims=True)
+        if np.any(norms == 0):
+            warnings.warn('Some microstates are never activated')
+            norms[norms == 0] = 1
+        maps = stats.sums / norms
+
+    # The maps of the last iteration, whose GEV is known
+    warnings.warn('Modified K-means algorithm failed to converge.')
+    return maps, stats.gev, max_iter
+
+
+def _open_shard(shard):
+    """Get the data of a shard, memory-mapping it when given a file name."""
+    if isinstance(shard, str):
+        return np.load(shard, mmap_mode='r')
+    return shard
+
+
+def _maps_fname(exchange_dir, iteration):
+    """The file holding the maps of an iteration."""
+    if iteration == 'final':
+        return os.path.join(exchange_dir, 'maps_final.npy')
+    return os.path.join(exchange_dir, 'maps_%05d.npy' % iteration)
+
+
+def _save_array(fname, array):
+    """Save an array to a .npy file, renaming it once fully written."""
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_fname, fname)
+
+
+def _wait_for(get, done, poll_interval, timeout):
+    """Poll until ``done(get())`` is true, and return the last ``get()``."""
+    start = time.time()
+    while True:
+        value = get()
+        if done(value):
+            return value
+        if timeout is not None and time.time() - start > timeout:
+            raise TimeoutError('Waited more than %g s for the other '
+                               'processes.' % timeout)
+        time.sleep(poll_interval)
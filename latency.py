@@ -0,0 +1,193 @@
+"""
+Latency instrumentation of the online processing loop.
+
+Each update of the loop is timed stage by stage with a monotonic clock. The
+durations are written into preallocated ring buffers, so timing adds no
+allocations to the loop. The time at which the display first showed the
+result of an update is added afterwards, which gives the latency from the
+newest sample of an update to the feedback on screen.
+"""
+import time
+import numpy as np
+from mne.utils import logger
+
+
+class LatencyMonitor(object):
+    """Per-stage timing of the updates of a processing loop.
+
+    Call :meth:`begin` at the start of an update, :meth:`mark` at the end of
+    each stage and :meth:`end` when the update is complete.
+
+    Parameters
+    ----------
+    stages : list of str
+        The names of the stages of an update.
+    capacity : int
+        The number of updates to keep. Older updates are overwritten.
+        Defaults to 100000.
+    clock : callable
+        The monotonic clock used to time the stages, returning seconds.
+        Defaults to ``time.perf_counter``.
+
+    Attributes
+    ----------
+    n_updates : int
+        The number of completed updates. This is also the sequence number
+        of the update in progress.
+    """
+    def __init__(self, stages, capacity=100000, clock=time.perf_counter):
+        self.stages = list(stages)
+        self.capacity = capacity
+        self.clock = clock
+        self.n_updates = 0
+        self._stage_index = {stage: i for i, stage in enumerate(self.stages)}
+        self._durations = np.full((capacity, len(self.stages)), np.nan)
+        self._start = np.full(capacity, np.nan)
+        self._n_samples = np.zeros(capacity, dtype=int)
+        self._sample_ts = np.full(capacity, np.nan)
+        self._flip_ts = np.full(capacity, np.nan)
+        self._row = 0
+        self._last = None
+
+    def begin(self):
+        """Start timing an update.
+
+        An update that is started again without calling :meth:`end`, for
+        example because no new data arrived, is discarded.
+        """
+        self._row = self.n_updates % self.capacity
+        self._durations[self._row] = np.nan
+        self._flip_ts[self._row] = np.nan
+        self._last = self._start[self._row] = self.clock()
+
+    def mark(self, stage):
+        """Record the end of a stage of the current update.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage. When a stage is marked several times in an
+            update, the durations are added up.
+        """
+        now = self.clock()
+        i = self._stage_index[stage]
+        duration = self._durations[self._row, i]
+        if np.isnan(duration):
+            duration = 0
+        self._durations[self._row, i] = duration + now - self._last
+        self._last = now
+
+    def end(self, n_samples=0, sample_ts=np.nan):
+        """Complete the current update.
+
+        Parameters
+        ----------
+        n_samples : int
+            The number of new samples processed in the update.
+        sample_ts : float
+            The timestamp of the newest sample processed in the update, on
+            the clock used by the display (the LSL clock).
+
+        Returns
+        -------
+        seq : int
+            The sequence number of the update.
+        """
+        self._n_samples[self._row] = n_samples
+        self._sample_ts[self._row] = sample_ts
+        self.n_updates += 1
+        return self.n_updates - 1
+
+    def add_display(self, seqs, flip_ts):
+        """Add the times at which the display showed the updates.
+
+        Parameters
+        ----------
+        seqs : array-like of int
+            The sequence numbers of the displayed updates.
+        flip_ts : array-like of float
+            For each update, the time of the first display flip showing it,
+            on the same clock as the sample timestamps.
+        """
+        seqs = np.asarray(seqs, dtype=int)
+        flip_ts = np.asarray(flip_ts, dtype=float)
+        kept = (seqs >= self.n_updates - self.capacity) & \
+            (seqs < self.n_updates)
+        self._flip_ts[seqs[kept] % self.capacity] = flip_ts[kept]
+
+    def _ordered(self, array):
+        """The values of the kept updates, oldest first."""
+        n = min(self.n_updates, self.capacity)
+        rows = np.arange(self.n_updates - n, self.n_updates) % self.capacity
+        return array[rows]
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """Compute percentiles of the duration of each stage.
+
+        Parameters
+        ----------
+        percentiles : tuple of float
+            The percentiles to compute. Defaults to ``(50, 95, 99)``.
+
+        Returns
+        -------
+        summary : dict
+            For each stage, the percentiles of its duration in ms. The key
+            ``'total'`` holds the duration of the whole update and the key
+            ``'feedback'`` the latency from the newest sample of an update to
+            the display flip showing it.
+        """
+        durations = self._ordered(self._durations) * 1000
+        feedback = (self._ordered(self._flip_ts) -
+                    self._ordered(self._sample_ts)) * 1000
+        columns = dict(zip(self.stages, durations.T))
+        columns['total'] = np.nansum(durations, axis=1)
+        columns['feedback'] = feedback
+        summary = dict()
+        for name, values in columns.items():
+            values = values[~np.isnan(values)]
+            if len(values) == 0:
+                summary[name] = np.full(len(percentiles), np.nan)
+            else:
+                summary[name] = np.percentile(values, percentiles)
+        return summary
+
+    def log_summary(self, percentiles=(50, 95, 99)):
+        """Log the percentiles of the duration of each stage.
+
+        Parameters
+        ----------
+        percentiles : tuple of float
+            The percentiles to log. Defaults to ``(50, 95, 99)``.
+        """
+        logger.info('Latency over %d updates [ms]: %s' % (
+            self.n_updates, ' / '.join('p%g' % p for p in percentiles)))
+        for name, values in self.summary(percentiles).items():
+            logger.info('  %-10s %s' % (
+                name, ' / '.join('%.2f' % v for v in values)))
+
+    def save(self, fname):
+        """Save the trace of the kept updates as a CSV file.
+
+        Parameters
+        ----------
+        fname : str
+            The name of the file. There is one row per update, with its
+            sequence number, start time, the duration of each stage in ms,
+            the number of new samples, the timestamp of the newest sample,
+            the time of the display flip and the feedback latency in ms.
+        """
+        n = min(self.n_updates, self.capacity)
+        sample_ts = self._ordered(self._sample_ts)
+        flip_ts = self._ordered(self._flip_ts)
+        trace = np.column_stack((
+            np.arange(self.n_updates - n, self.n_updates),
+            self._ordered(self._start),
+            self._ordered(self._durations) * 1000,
+            self._ordered(self._n_samples),
+            sample_ts, flip_ts, (flip_ts - sample_ts) * 1000))
+        header = ['seq', 'start'] + self.stages + \
+            ['n_samples', 'sample_ts', 'flip_ts', 'feedback']
+        np.savetxt(fname, trace, delimiter=',', header=','.join(header),
+                   comments='', fmt='%.6f')
+        logger.info('Latency trace saved to %s' % fname)
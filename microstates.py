@@ -9,11 +9,17 @@ References
 .. [1]  Poulsen, A. T., Pedroni, A., Langer, N., &  Hansen, L. K. (2018).
         Microstate EEGlab toolbox: An introductionary guide. bioRxiv.
 """
+import os
+import shutil
+import tempfile
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+
 import numpy as np
-from scipy.stats import zscore
 from scipy.signal import find_peaks
 from scipy.linalg import eigh
+from scipy.sparse import csr_matrix
 import matplotlib as mpl
 from matplotlib import pyplot as plt
 import mne
@@ -23,19 +29,28 @@ from mne.utils import logger, verbose
 @verbose
 def segment(data, n_states=4, n_inits=10, max_iter=1000, thresh=1e-6,
             normalize=False, min_peak_dist=2, max_n_peaks=10000,
-            random_state=None, verbose=None):
+            use_peaks=True, n_components=None, method='kmeans', init='random',
+            prune=None, n_jobs=1, chunk_size=None, smooth_width=None,
+            smooth_lambda=5., min_segment_length=None, return_gev=False,
+            return_n_iter=False, random_state=None, verbose=None):
     """Segment a continuous signal into microstates.
 
     Peaks in the global field power (GFP) are used to find microstates, using a
     modified K-means algorithm. Several runs of the modified K-means algorithm
     are performed, using different random initializations. The run that
     resulted in the best segmentation, as measured by global explained variance
-    (GEV), is used.
+    (GEV), is used. Alternatively, the deterministic atomize and agglomerate
+    hierarchical clustering (AAHC) [2]_ can be used, in a single run. The
+    resulting maps are then back-fitted to all samples of the data to obtain
+    the final segmentation.
 
     Parameters
     ----------
-    data : ndarray, shape (n_channels, n_samples)
-        The data to find the microstates in
+    data : ndarray, shape (n_channels, n_samples) | instance of Raw
+        The data to find the microstates in. This can also be a
+        ``numpy.memmap`` or a ``Raw`` object that was loaded with
+        ``preload=False``, in which case the data is read in chunks of
+        ``chunk_size`` samples.
     n_states : int
         The number of unique microstates to find. Defaults to 4.
     n_inits : int
@@ -53,13 +68,92 @@ def segment(data, n_states=4, n_inits=10, max_iter=1000, thresh=1e-6,
         k-means algorithm. Defaults to ``False``.
     min_peak_dist : int
         Minimum distance (in samples) between peaks in the GFP. Defaults to 2.
-    max_n_peaks : int
+    max_n_peaks : int | None
         Maximum number of GFP peaks to use in the k-means algorithm. Chosen
-        randomly. Defaults to 10000.
+        randomly. Set to ``None`` to use all peaks. Defaults to 10000.
+    use_peaks : bool
+        Whether to fit the k-means algorithm on the topographies at the GFP
+        peaks only. The cost of the fit then scales with ``max_n_peaks``
+        rather than with the length of the recording. When ``False``, all
+        samples are used. Defaults to ``True``.
+    n_components : int | float | None
+        When given, the topographies are clustered in the subspace of their
+        first principal components, which makes each iteration cheaper for
+        high-density montages. When an int, the number of components. When
+        a float between 0 and 1, the smallest number of components that
+        explain this fraction of the variance of the topographies, for
+        example 0.99. The maps are projected back to the channels, and the
+        GEV of each initialization is computed on the channels, so it can
+        be compared with a fit without reduction. Defaults to ``None``, in
+        which case the channels are clustered.
+    method : 'kmeans' | 'aahc'
+        The clustering algorithm. ``'kmeans'`` is the modified K-means, with
+        ``n_inits`` initializations. ``'aahc'`` is the atomize and
+        agglomerate hierarchical clustering, which is deterministic and run
+        once, so ``n_inits``, ``init``, ``prune``, ``n_jobs`` and
+        ``random_state`` (except for choosing the peaks) do not apply. Its
+        memory is O(n_peaks * n_channels), but its time grows with the
+        square of the number of peaks, so ``max_n_peaks`` should stay in
+        the tens of thousands. Defaults to ``'kmeans'``.
+    init : 'random' | 'k-means++'
+        How the maps of each initialization are chosen among the fitted
+        topographies. ``'random'`` picks them uniformly. ``'k-means++'``
+        picks them one by one, each topography with a probability
+        proportional to its residual variance given the maps picked so far:
+        its squared norm times one minus its squared spatial correlation
+        with the closest map, regardless of polarity. Strong topographies
+        that are unlike the maps picked so far are thus favoured, which
+        usually needs fewer iterations and initializations to reach the
+        same GEV. Defaults to ``'random'``.
+    prune : float | None
+        When given, initializations that cannot plausibly beat the best one
+        are abandoned before they converge. The fraction of variance
+        explained by the maps of each initialization (its GEV for average
+        referenced data) only grows over the iterations. After each
+        iteration, its remaining growth is extrapolated from its last two
+        improvements, assuming they decrease geometrically. The
+        initialization is abandoned when, even with that growth and an
+        extra margin of ``prune``, it stays below the best initialization
+        so far. Larger values prune less. Initializations whose
+        improvements do not decrease are never abandoned, and neither is
+        the best one. With ``n_jobs > 1``, the best initialization is that
+        of the same process. Defaults to ``None``, in which case all
+        initializations run until they converge.
+    n_jobs : int
+        The number of processes to spread the random initializations over.
+        The data is shared with the worker processes through a memory-mapped
+        file rather than copied to each of them. Set to ``-1`` to use all
+        CPU cores. Defaults to 1.
+    chunk_size : int | None
+        The number of samples to process at a time when computing the GFP,
+        collecting the peaks and back-fitting the maps. Only one chunk of
+        the data is held in memory at a time, but the GFP of the whole
+        recording (one value per sample, like the segmentation) is kept to
+        find its peaks. When ``use_peaks=False`` all samples are clustered
+        and hence loaded. Defaults to ``None``, in which case all samples
+        are processed at once.
+    smooth_width : int | None
+        The half-width (in samples) of the window used to smooth the final
+        segmentation with :func:`smooth_segmentation`. This requires the
+        activation of each map at each sample to fit in memory. Defaults to
+        ``None``, in which case the segmentation is not smoothed.
+    smooth_lambda : float
+        The smoothness penalty of the windowed smoothing. Defaults to 5.
+    min_segment_length : int | None
+        Segments of the final segmentation that are shorter than this many
+        samples are reassigned to their neighbours with
+        :func:`reject_short_segments`. Defaults to ``None``.
+    return_gev : bool
+        Whether to also return the global explained variance (GEV) of the
+        final segmentation. Defaults to ``False``.
+    return_n_iter : bool
+        Whether to also return the number of iterations of the k-means
+        algorithm for the best initialization. Defaults to ``False``.
     random_state : int | numpy.random.RandomState | None
-        The seed or ``RandomState`` for the random number generator. Defaults
-        to ``None``, in which case a different seed is chosen each time this
-        function is called.
+        The seed or ``RandomState`` for the random number generator. Each
+        random initialization draws its own seed from it, so the result does
+        not depend on ``n_jobs``. Defaults to ``None``, in which case a
+        different seed is chosen each time this function is called.
     verbose : int | bool | None
         Controls the verbosity.
 
@@ -70,6 +164,13 @@ def segment(data, n_states=4, n_inits=10, max_iter=1000, thresh=1e-6,
     segmentation : ndarray, shape (n_samples,)
         For each sample, the index of the microstate to which the sample has
         been assigned.
+    gev : float
+        The global explained variance of the segmentation. Only returned when
+        ``return_gev=True``.
+    n_iter : int
+        The number of iterations of the k-means algorithm for the best
+        initialization, or the number of atomized clusters for AAHC. Only
+        returned when ``return_n_iter=True``.
 
     References
     ----------
@@ -77,112 +178,1183 @@ def segment(data, n_states=4, n_inits=10, max_iter=1000, thresh=1e-6,
            Segmentation of brain electrical activity into microstates: model
            estimation and validation. IEEE Transactions on Biomedical
            Engineering.
+    .. [2] Murray, M. M., Brunet, D., & Michel, C. M. (2008). Topographic
+           ERP analyses: a step-by-step tutorial review. Brain Topography.
     """
-    logger.info('Finding %d microstates, using %d random intitializations' %
-                (n_states, n_inits))
+    _check_method(method)
+    _check_init(init)
+    if method == 'aahc':
+        logger.info('Finding %d microstates, using AAHC' % n_states)
+    else:
+        logger.info('Finding %d microstates, using %d random '
+                    'intitializations' % (n_states, n_inits))
+
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+
+    fit_data, fit_gfp, scaling = _fit_data(data, normalize, min_peak_dist,
+                                           max_n_peaks, use_peaks, chunk_size,
+                                           random_state)
+    cluster_data, cluster_gfp, components = _reduce(fit_data, fit_gfp,
+                                                    n_components)
 
-    if normalize:
-        data = zscore(data, axis=1)
+    # Do several runs of the k-means algorithm, keep track of the best
+    # segmentation.
+    seeds = random_state.randint(np.iinfo(np.int32).max, size=n_inits)
+    if method == 'aahc':
+        results = _fit_aahc(cluster_data, cluster_gfp, [n_states],
+                            verbose)[0]
+    elif n_jobs == 1:
+        results = _fit_restarts(cluster_data, cluster_gfp, seeds, n_states,
+                                max_iter, thresh, init, prune, verbose)
+    else:
+        results = _parallel_restarts(cluster_data, seeds, n_states, max_iter,
+                                     thresh, init, prune, n_jobs, verbose)
+    if components is not None:
+        results = _to_channels(results, components, fit_data, fit_gfp)
+
+    best_gev = 0
+    best_maps = best_n_iter = None
+    for maps, gev, n_iter, pruned in results:
+        if pruned:
+            logger.info('GEV of abandoned microstates: %f (%d iterations)' %
+                        (gev, n_iter))
+            continue
+        logger.info('GEV of found microstates: %f (%d iterations)' %
+                    (gev, n_iter))
+        if gev > best_gev:
+            best_gev, best_maps, best_n_iter = gev, maps, n_iter
+    logger.info('%d iterations in total, %d for the best initialization, '
+                '%d of %d initializations abandoned' %
+                (sum(result[2] for result in results), best_n_iter,
+                 sum(result[3] for result in results), len(results)))
+
+    # Back-fit the best maps to all samples of the recording
+    segmentation, gev = _backfit_chunks(data, best_maps, chunk_size, scaling)
+    if use_peaks:
+        logger.info('GEV after back-fitting: %f' % gev)
+
+    # Smooth the segmentation in time
+    if smooth_width is not None or min_segment_length is not None:
+        act_sq, data_sq = _activations(data, best_maps, chunk_size, scaling)
+        if smooth_width is not None:
+            segmentation = _smooth_labels(act_sq, data_sq, segmentation,
+                                          _n_channels(data), smooth_width,
+                                          smooth_lambda, max_iter, thresh)
+        if min_segment_length is not None:
+            segmentation = reject_short_segments(segmentation,
+                                                 min_segment_length)
+        gev = np.sum(np.take_along_axis(act_sq, segmentation[np.newaxis],
+                                        axis=0)) / np.sum(data_sq)
+        logger.info('GEV after smoothing: %f' % gev)
+
+    out = (best_maps, segmentation)
+    if return_gev:
+        out += (gev,)
+    if return_n_iter:
+        out += (best_n_iter,)
+    return out
+
+
+@verbose
+def select_n_states(data, n_states=range(2, 13), n_inits=10, max_iter=1000,
+                    thresh=1e-6, normalize=False, min_peak_dist=2,
+                    max_n_peaks=10000, use_peaks=True, n_components=None,
+                    method='kmeans', init='random', prune=None, n_jobs=1,
+                    chunk_size=None, n_silhouette=1000, random_state=None,
+                    verbose=None):
+    """Fit microstates for a range of numbers of states, to choose one.
 
-    # Find peaks in the global field power (GFP)
-    gfp = np.mean(data ** 2, axis=0)
+    The GFP peaks are extracted once, as in :func:`segment`, and the
+    modified K-means algorithm is run on them for each number of states,
+    with ``n_inits`` random initializations each. The fits can be spread
+    over processes, sharing the peaks through a memory-mapped file. With
+    AAHC, a single run gives the maps for all numbers of states. For the
+    best maps of each number of states, the usual criteria are computed on
+    the fitted topographies:
+
+    - the global explained variance (GEV), higher is better;
+    - the cross-validation criterion of Pascual-Marqui et al. (1995),
+      lower is better;
+    - the Krzanowski-Lai criterion, as used by Murray et al. (2008), higher
+      is better. It needs the fits for one state less and one state more,
+      so it is NaN for the smallest and largest number of states.
+    - the mean silhouette, on a random subsample of the topographies,
+      with one minus the absolute spatial correlation as distance. Higher
+      is better.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_samples) | instance of Raw
+        The data to find the microstates in. See :func:`segment`.
+    n_states : list of int
+        The numbers of states to try. Defaults to 2 to 12.
+    n_inits : int
+        The number of random initializations for each number of states.
+        Defaults to 10.
+    max_iter : int
+        The maximum number of iterations of the k-means algorithm.
+        Defaults to 1000.
+    thresh : float
+        The threshold of convergence of the k-means algorithm. Defaults to
+        1e-6.
+    normalize : bool
+        Whether to normalize (z-score) the data across time. Defaults to
+        ``False``.
+    min_peak_dist : int
+        Minimum distance (in samples) between peaks in the GFP. Defaults to 2.
+    max_n_peaks : int | None
+        Maximum number of GFP peaks to use. Defaults to 10000.
+    use_peaks : bool
+        Whether to fit on the GFP peaks only. Defaults to ``True``.
+    n_components : int | float | None
+        The number of principal components, or the fraction of variance
+        they explain, to cluster in. The criteria are computed on the
+        channels. See :func:`segment`. Defaults to ``None``.
+    method : 'kmeans' | 'aahc'
+        The clustering algorithm. See :func:`segment`. Defaults to
+        ``'kmeans'``.
+    init : 'random' | 'k-means++'
+        How the maps of each initialization are chosen. See
+        :func:`segment`. Defaults to ``'random'``.
+    prune : float | None
+        The margin to abandon initializations that cannot beat the best one.
+        See :func:`segment`. Defaults to ``None``.
+    n_jobs : int
+        The number of processes to spread the fits over. Set to ``-1`` to
+        use all CPU cores. Defaults to 1.
+    chunk_size : int | None
+        The number of samples to process at a time when extracting the
+        peaks. Defaults to ``None``.
+    n_silhouette : int
+        The number of topographies to compute the silhouette on. Defaults
+        to 1000.
+    random_state : int | numpy.random.RandomState | None
+        The seed or ``RandomState`` for the random number generator.
+        Defaults to ``None``.
+    verbose : int | bool | None
+        Controls the verbosity.
+
+    Returns
+    -------
+    maps : dict
+        For each number of states, the best maps found, as an ndarray of
+        shape (n_states, n_channels).
+    scores : dict
+        The criteria, each as an ndarray with a value for each number of
+        states: ``'n_states'``, ``'gev'``, ``'cv'``, ``'kl'`` and
+        ``'silhouette'``.
+
+    References
+    ----------
+    .. [1] Pascual-Marqui, R. D., Michel, C. M., & Lehmann, D. (1995).
+           Segmentation of brain electrical activity into microstates: model
+           estimation and validation. IEEE Transactions on Biomedical
+           Engineering.
+    .. [2] Murray, M. M., Brunet, D., & Michel, C. M. (2008). Topographic
+           ERP analyses: a step-by-step tutorial review. Brain Topography.
+    """
+    _check_method(method)
+    _check_init(init)
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+    n_states = sorted(n_states)
+
+    fit_data, fit_gfp, _ = _fit_data(data, normalize, min_peak_dist,
+                                     max_n_peaks, use_peaks, chunk_size,
+                                     random_state)
+    cluster_data, cluster_gfp, components = _reduce(fit_data, fit_gfp,
+                                                    n_components)
+    tasks = [(k, random_state.randint(np.iinfo(np.int32).max, size=n_inits))
+             for k in n_states]
+    if method == 'aahc':
+        results = _fit_aahc(cluster_data, cluster_gfp, n_states, verbose)
+    elif n_jobs == 1:
+        results = [_fit_restarts(cluster_data, cluster_gfp, seeds, k,
+                                 max_iter, thresh, init, prune, verbose)
+                   for k, seeds in tasks]
+    else:
+        results = _parallel_fits(cluster_data, tasks, max_iter, thresh, init,
+                                 prune, n_jobs, verbose)
+    if components is not None:
+        results = [_to_channels(restarts, components, fit_data, fit_gfp)
+                   for restarts in results]
+
+    all_maps = dict()
+    for k, restarts in zip(n_states, results):
+        finished = [result for result in restarts if not result[3]]
+        all_maps[k] = max(finished, key=lambda result: result[1])[0]
+
+    # The criteria are computed on the centered topographies, using the
+    # activations of the best maps.
+    n_channels, n_samples = fit_data.shape
+    centered = fit_data - np.mean(fit_data, axis=0)
+    data_sq = np.sum(centered ** 2, axis=0)
+    unit = centered / np.sqrt(np.where(data_sq == 0, 1, data_sq))
+    subsample = random_state.choice(n_samples, min(n_silhouette, n_samples),
+                                    replace=False)
+    sub_corr = np.abs(unit[:, subsample].T.dot(unit[:, subsample]))
+
+    scores = dict(n_states=np.array(n_states), gev=[], cv=[], dispersion=[],
+                  silhouette=[])
+    for k in n_states:
+        activation = normalize_templates(all_maps[k]).dot(fit_data)
+        labels = np.argmax(np.abs(activation), axis=0)
+        assigned = activation[labels, np.arange(n_samples)]
+        scores['gev'].append(np.sum(assigned ** 2) / np.sum(data_sq))
+
+        # Cross-validation criterion
+        noise_var = (np.sum(data_sq) - np.sum(assigned ** 2)) / \
+            (n_samples * (n_channels - 1))
+        scores['cv'].append(noise_var * ((n_channels - 1) /
+                                         (n_channels - 1 - k)) ** 2
+                            if k < n_channels - 1 else np.nan)
+
+        # Dispersion of the topographies, with their polarity aligned to
+        # their map, for the Krzanowski-Lai criterion
+        aligned = unit * np.sign(assigned)
+        one_hot = np.zeros((k, n_samples))
+        one_hot[labels, np.arange(n_samples)] = 1
+        sums = aligned.dot(one_hot.T)
+        counts = np.maximum(np.sum(one_hot, axis=1), 1)
+        scores['dispersion'].append(n_samples -
+                                    np.sum(np.sum(sums ** 2, axis=0) / counts))
+
+        scores['silhouette'].append(_silhouette(1 - sub_corr,
+                                                labels[subsample], k))
+        logger.info('%d states: GEV %f, CV %f, silhouette %f' %
+                    (k, scores['gev'][-1], scores['cv'][-1],
+                     scores['silhouette'][-1]))
+    scores = {name: np.asarray(score) for name, score in scores.items()}
+
+    # Krzanowski-Lai criterion, for consecutive numbers of states only
+    dispersion = scores.pop('dispersion')
+    ks = scores['n_states']
+    weighted = ks ** (2. / n_channels) * dispersion
+    diff = np.full(len(ks), np.nan)
+    diff[1:] = np.where(np.diff(ks) == 1, weighted[:-1] - weighted[1:], np.nan)
+    scores['kl'] = np.full(len(ks), np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores['kl'][:-1] = np.abs(diff[:-1] / diff[1:])
+    for k, kl in zip(ks, scores['kl']):
+        logger.info('%d states: Krzanowski-Lai %f' % (k, kl))
+    return all_maps, scores
+
+
+def _silhouette(distances, labels, n_states):
+    """The mean silhouette of a clustering, from all pairwise distances."""
+    n_samples = len(labels)
+    one_hot = np.zeros((n_samples, n_states))
+    one_hot[np.arange(n_samples), labels] = 1
+    counts = np.sum(one_hot, axis=0)
+    # Mean distance from each sample to the samples of each cluster, leaving
+    # out the sample itself.
+    mean_dist = distances.dot(one_hot)
+    own = np.arange(n_samples), labels
+    own_counts = counts[labels] - 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        within = mean_dist[own] / own_counts
+        mean_dist /= counts
+    mean_dist[own] = np.inf
+    between = np.min(mean_dist, axis=1)
+    silhouette = (between - within) / np.maximum(within, between)
+    silhouette[own_counts == 0] = 0
+    return np.mean(silhouette)
+
+
+@verbose
+def backfit(data, maps, normalize=False, chunk_size=None, verbose=None):
+    """Assign each sample to the microstate with the best matching map.
+
+    Samples are labelled by the absolute spatial correlation with the maps,
+    using :func:`match_templates`.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_samples) | instance of Raw
+        The data to segment. This can also be a ``numpy.memmap`` or a
+        ``Raw`` object that was loaded with ``preload=False``, in which case
+        the data is read in chunks of ``chunk_size`` samples.
+    maps : ndarray, shape (n_states, n_channels)
+        The topographic maps of the microstates, as returned by
+        :func:`segment`.
+    normalize : bool
+        Whether to normalize (z-score) the data across time before
+        back-fitting. This should match the setting used with
+        :func:`segment`. Defaults to ``False``.
+    chunk_size : int | None
+        The number of samples to process at a time. Apart from the returned
+        segmentation, memory use is bounded by the size of a chunk,
+        regardless of the length of the recording.
+        Defaults to ``None``, in which case all samples are processed at
+        once.
+    verbose : int | bool | None
+        Controls the verbosity.
+
+    Returns
+    -------
+    segmentation : ndarray, shape (n_samples,)
+        For each sample, the index of the microstate to which the sample has
+        been assigned.
+    gev : float
+        The global explained variance (GEV) of the segmentation.
+    """
+    scaling = _channel_scaling(data, chunk_size) if normalize else None
+    return _backfit_chunks(data, maps, chunk_size, scaling)
+
+
+def _n_samples(data):
+    """Get the number of samples of an array or Raw object."""
+    if isinstance(data, mne.io.BaseRaw):
+        return data.n_times
+    return data.shape[1]
+
+
+def _n_channels(data):
+    """Get the number of channels of an array or Raw object."""
+    if isinstance(data, mne.io.BaseRaw):
+        return len(data.ch_names)
+    return data.shape[0]
+
+
+def _iter_chunks(data, chunk_size=None, scaling=None):
+    """Iterate over consecutive blocks of samples.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_samples) | instance of Raw
+        The data to iterate over.
+    chunk_size : int | None
+        The number of samples in each block. When ``None``, a single block
+        with all the data is produced.
+    scaling : tuple of ndarray | None
+        The mean and standard deviation of each channel, used to z-score each
+        block. When ``None``, the blocks are not normalized.
+
+    Yields
+    ------
+    start : int
+        The index of the first sample of the block.
+    block : ndarray, shape (n_channels, n_block_samples)
+        The data of the block.
+    """
+    n_samples = _n_samples(data)
+    if chunk_size is None:
+        chunk_size = n_samples
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        if isinstance(data, mne.io.BaseRaw):
+            block = data.get_data(start=start, stop=stop)
+        else:
+            block = np.asarray(data[:, start:stop])
+        if scaling is not None:
+            mean, std = scaling
+            block = (block - mean[:, np.newaxis]) / std[:, np.newaxis]
+        yield start, block
+
+
+def _channel_scaling(data, chunk_size=None):
+    """Compute the mean and standard deviation of each channel, in chunks."""
+    n_samples = _n_samples(data)
+    mean = sum(np.sum(block, axis=1)
+               for _, block in _iter_chunks(data, chunk_size)) / n_samples
+    var = sum(np.sum((block - mean[:, np.newaxis]) ** 2, axis=1)
+              for _, block in _iter_chunks(data, chunk_size)) / n_samples
+    return mean, np.sqrt(var)
+
+
+def _fit_data(data, normalize, min_peak_dist, max_n_peaks, use_peaks,
+              chunk_size, random_state):
+    """Collect the data to fit the k-means algorithm on.
+
+    See :func:`segment` for the parameters. Returns the topographies to
+    cluster, their GFP and the scaling used to normalize the data.
+    """
+    scaling = _channel_scaling(data, chunk_size) if normalize else None
+
+    # Find peaks in the global field power (GFP). The GFP of the whole
+    # recording is kept, as find_peaks needs all of it.
+    gfp = np.concatenate([_gfp(block) for _, block
+                          in _iter_chunks(data, chunk_size, scaling)])
     peaks, _ = find_peaks(gfp, distance=min_peak_dist)
     n_peaks = len(peaks)
 
     # Limit the number of peaks by randomly selecting them
     if max_n_peaks is not None:
         max_n_peaks = min(n_peaks, max_n_peaks)
-        if not isinstance(random_state, np.random.RandomState):
-            random_state = np.random.RandomState(random_state)
         chosen_peaks = random_state.choice(n_peaks, size=max_n_peaks,
                                            replace=False)
-        peaks = peaks[chosen_peaks]
+        peaks = np.sort(peaks[chosen_peaks])
 
-    # Cache this value for later
-    gfp_sum_sq = np.sum(gfp ** 2)
+    # Only the topographies at the GFP peaks are clustered
+    if use_peaks:
+        logger.info('Fitting on %d GFP peaks' % len(peaks))
+        return (_take_samples(data, peaks, chunk_size, scaling), gfp[peaks],
+                scaling)
+    fit_data = np.hstack([block for _, block
+                          in _iter_chunks(data, None, scaling)])
+    return fit_data, gfp, scaling
+
+
+def _reduce(data, gfp, n_components):
+    """Project the topographies on their first principal components.
+
+    The components are the first eigenvectors of the scatter matrix of the
+    topographies across channels. The topographies are not centered over
+    time, since the clustering ignores their polarity.
+
+    Returns
+    -------
+    data : ndarray, shape (n_components, n_samples)
+        The projected topographies, or the topographies themselves when
+        ``n_components`` is ``None``.
+    gfp : ndarray, shape (n_samples,)
+        The GFP of the returned topographies.
+    components : ndarray, shape (n_components, n_channels) | None
+        The components, or ``None`` when ``n_components`` is ``None``.
+    """
+    if n_components is None:
+        return data, gfp, None
+    n_channels = data.shape[0]
+    eigenvalues, eigenvectors = eigh(data.dot(data.T))
+    eigenvalues, eigenvectors = eigenvalues[::-1], eigenvectors[:, ::-1]
+    explained = np.cumsum(eigenvalues) / np.sum(eigenvalues)
+    if 0 < n_components < 1:
+        n_components = np.searchsorted(explained, n_components) + 1
+    n_components = min(int(n_components), n_channels)
+    logger.info('Clustering on %d of %d components, explaining %.2f%% of the '
+                'variance' % (n_components, n_channels,
+                              100 * explained[n_components - 1]))
+    components = eigenvectors[:, :n_components].T
+    data = components.dot(data)
+    return data, _gfp(data), components
+
+
+def _to_channels(results, components, data, gfp):
+    """Project the maps fitted on principal components back to the channels.
+
+    The GEV of each result, as returned by :func:`_fit_restarts`, is
+    recomputed on the channels.
+    """
+    channel_results = []
+    for maps, _, n_iter, pruned in results:
+        maps = maps.dot(components)
+        norms = np.linalg.norm(maps, axis=1, keepdims=True)
+        maps /= np.where(norms == 0, 1, norms)
+        segmentation = np.argmax(np.abs(maps.dot(data)), axis=0)
+        channel_results.append((maps, _gev(data, maps, segmentation, gfp),
+                                n_iter, pruned))
+    return channel_results
 
-    # Do several runs of the k-means algorithm, keep track of the best
-    # segmentation.
-    best_gev = 0
-    best_maps = None
-    best_segmentation = None
-    for _ in range(n_inits):
-        maps, segmentation = _mod_kmeans(data, n_states, n_inits, max_iter,
-                                         thresh, random_state, verbose)
-        map_corr = _corr_vectors(data, maps[segmentation].T)
-
-        # Compare across iterations using global explained variance (GEV) of
-        # the found microstates.
-        gev = sum((gfp * map_corr) ** 2) / gfp_sum_sq
-        logger.info('GEV of found microstates: %f' % gev)
-        if gev > best_gev:
-            best_gev, best_maps, best_segmentation = gev, maps, segmentation
 
-    return best_maps, best_segmentation
+def _take_samples(data, samples, chunk_size=None, scaling=None):
+    """Collect the data at the given (sorted) samples, in chunks."""
+    blocks = []
+    for start, block in _iter_chunks(data, chunk_size, scaling):
+        first, last = np.searchsorted(samples, [start, start + block.shape[1]])
+        blocks.append(block[:, samples[first:last] - start])
+    return np.hstack(blocks)
+
+
+def _backfit_chunks(data, maps, chunk_size=None, scaling=None):
+    """Back-fit maps and compute the GEV, in chunks.
+
+    See :func:`backfit` for the parameters.
+    """
+    templates = normalize_templates(maps)
+    segmentation = np.empty(_n_samples(data), dtype=np.intp)
+    gev_sum = gfp_sum_sq = 0
+    for start, block in _iter_chunks(data, chunk_size, scaling):
+        block_segmentation, map_corr = match_templates(block, templates)
+        segmentation[start:start + block.shape[1]] = block_segmentation
+
+        gfp = _gfp(block)
+        gev_sum += np.sum((gfp * map_corr) ** 2)
+        gfp_sum_sq += np.sum(gfp ** 2)
+    return segmentation, gev_sum / gfp_sum_sq
+
+
+def _activations(data, maps, chunk_size=None, scaling=None):
+    """Compute the squared activation of each map at each sample, in chunks.
+
+    Returns the squared activations of the normalized maps, shape
+    (n_states, n_samples), and the squared norm of each sample after
+    centering across channels, shape (n_samples,).
+    """
+    templates = normalize_templates(maps)
+    n_samples = _n_samples(data)
+    act_sq = np.empty((len(templates), n_samples))
+    data_sq = np.empty(n_samples)
+    for start, block in _iter_chunks(data, chunk_size, scaling):
+        stop = start + block.shape[1]
+        act_sq[:, start:stop] = templates.dot(block) ** 2
+        data_sq[start:stop] = np.sum(
+            (block - np.mean(block, axis=0)) ** 2, axis=0)
+    return act_sq, data_sq
+
+
+def _fit_restarts(data, gfp, seeds, n_states, max_iter, thresh, init, prune,
+                  verbose):
+    """Perform a run of the modified K-means algorithm for each seed.
+
+    Returns for each run the maps, their global explained variance (GEV),
+    which is used to compare the runs, the number of iterations and whether
+    the run was abandoned.
+    """
+    maps, segmentations, n_iter, pruned = _mod_kmeans(
+        data, n_states, seeds, max_iter, thresh, init, prune, verbose)
+    return [(m, _gev(data, m, s, gfp), n, p) for m, s, n, p
+            in zip(maps, segmentations, n_iter, pruned)]
+
+
+def _fit_aahc(data, gfp, n_states, verbose):
+    """Perform AAHC, keeping the maps at each given number of states.
+
+    Returns for each number of states a list with a single result, in the
+    format of :func:`_fit_restarts`. The number of iterations is the number
+    of atomized clusters.
+    """
+    all_maps = _aahc(data, n_states, verbose)
+    results = []
+    for k in n_states:
+        maps = all_maps[k]
+        segmentation = np.argmax(np.abs(maps.dot(data)), axis=0)
+        gev = _gev(data, maps, segmentation, gfp)
+        results.append([(maps, gev, data.shape[1] - k, False)])
+    return results
+
+
+# The data shared with the worker processes of _parallel_restarts
+_worker_data = dict()
+
+
+def _init_worker(fname):
+    """Map the shared data into the memory of a worker process."""
+    data = np.load(fname, mmap_mode='r')
+    _worker_data['data'] = data
+    _worker_data['gfp'] = _gfp(data)
+
+
+def _worker_restarts(seeds, n_states, max_iter, thresh, init, prune,
+                     verbose):
+    """Perform runs of the modified K-means in a worker process."""
+    return _fit_restarts(_worker_data['data'], _worker_data['gfp'], seeds,
+                         n_states, max_iter, thresh, init, prune, verbose)
+
+
+def _parallel_restarts(data, seeds, n_states, max_iter, thresh, init, prune,
+                       n_jobs, verbose):
+    """Spread runs of the modified K-means over a pool of processes.
+
+    Each worker performs its share of the runs as a single batch.
+    """
+    if n_jobs < 0:
+        n_jobs = mp.cpu_count()
+    n_jobs = min(n_jobs, len(seeds))
+    logger.info('Running %d random initializations over %d processes' %
+                (len(seeds), n_jobs))
+    tasks = [(n_states, batch) for batch in np.array_split(seeds, n_jobs)]
+    results = _parallel_fits(data, tasks, max_iter, thresh, init, prune,
+                             n_jobs, verbose)
+    return [result for batch in results for result in batch]
+
+
+def _parallel_fits(data, tasks, max_iter, thresh, init, prune, n_jobs,
+                   verbose):
+    """Perform batches of runs of the modified K-means in a process pool.
+
+    The data is written once to a memory-mapped file that all workers map
+    read-only, instead of being pickled and sent to each of them. Each task
+    is a tuple ``(n_states, seeds)``, and the results of each task, as
+    returned by :func:`_fit_restarts`, are returned in the same order.
+    """
+    if n_jobs < 0:
+        n_jobs = mp.cpu_count()
+
+    tmp_dir = tempfile.mkdtemp(prefix='microstates_')
+    try:
+        fname = os.path.join(tmp_dir, 'data.npy')
+        shared = np.lib.format.open_memmap(fname, mode='w+', dtype=data.dtype,
+                                           shape=data.shape)
+        shared[:] = data
+        shared.flush()
+        del shared
+
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(fname,)) as executor:
+            futures = [executor.submit(_worker_restarts, seeds, n_states,
+                                       max_iter, thresh, init, prune,
+                                       verbose)
+                       for n_states, seeds in tasks]
+            return [future.result() for future in futures]
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
 @verbose
-def _mod_kmeans(data, n_states=4, n_inits=10, max_iter=1000, thresh=1e-6,
-                random_state=None, verbose=None):
+def _mod_kmeans(data, n_states=4, seeds=(None,), max_iter=1000, thresh=1e-6,
+                init='random', prune=None, verbose=None):
     """The modified K-means clustering algorithm.
 
-    See :func:`segment` for the meaning of the parameters and return
-    values.
+    One run of the algorithm is performed for each given seed. The runs are
+    computed together: the maps of all runs are stacked into a single
+    ``(n_runs * n_states, n_channels)`` matrix, so each iteration needs only a
+    single matrix product with the data. Runs that have converged, or that
+    were abandoned because they cannot beat the best run (see the ``prune``
+    parameter of :func:`segment`), are no longer updated.
+
+    See :func:`segment` for the meaning of the other parameters.
+
+    Returns
+    -------
+    maps : ndarray, shape (n_runs, n_states, n_channels)
+        For each run, the topographic maps of the found microstates.
+    segmentation : ndarray, shape (n_runs, n_samples)
+        For each run, the index of the microstate to which each sample has
+        been assigned.
+    n_iter : ndarray of int, shape (n_runs,)
+        For each run, the number of iterations performed.
+    pruned : ndarray of bool, shape (n_runs,)
+        For each run, whether it was abandoned before converging.
     """
-    if not isinstance(random_state, np.random.RandomState):
-        random_state = np.random.RandomState(random_state)
     n_channels, n_samples = data.shape
+    n_runs = len(seeds)
 
     # Cache this value for later
     data_sum_sq = np.sum(data ** 2)
 
-    # Select random timepoints for our initial topographic maps
-    init_times = random_state.choice(n_samples, size=n_states, replace=False)
-    maps = data[:, init_times].T
-    maps /= np.linalg.norm(maps, axis=1, keepdims=True)  # Normalize the maps
+    # Select timepoints for our initial topographic maps. Each run uses its
+    # own random number generator.
+    if init == 'k-means++':
+        maps = _kmeans_plusplus(data, n_states, seeds)
+    else:
+        maps = np.empty((n_runs, n_states, n_channels))
+        for run, seed in enumerate(seeds):
+            random_state = np.random.RandomState(seed)
+            init_times = random_state.choice(n_samples, size=n_states,
+                                             replace=False)
+            maps[run] = data[:, init_times].T
+    maps /= np.linalg.norm(maps, axis=2, keepdims=True)  # Normalize the maps
 
-    prev_residual = np.inf
+    # Buffers for the activations, reused across iterations. The one-hot
+    # assignment matrix has one non-zero per sample for each run, so only its
+    # indices and values need to be filled in.
+    activation_buf = np.empty((n_runs * n_states, n_samples))
+    abs_buf = np.empty((n_runs * n_states, n_samples))
+    offsets = n_states * np.arange(n_runs)[:, None]
+
+    # The product of the data with a sparse matrix is computed by scipy on
+    # the transposed data, which it copies unless it is C-contiguous. Make
+    # that copy once, rather than at every iteration.
+    data_T = np.ascontiguousarray(data.T)
+
+    # The runs that have not converged yet
+    active = np.arange(n_runs)
+    prev_residual = np.full(n_runs, np.inf)
+    n_iter = np.full(n_runs, max_iter)
+
+    # The fraction of variance explained by the maps of each run, and its
+    # last two improvements, to decide which runs to abandon
+    explained = np.zeros(n_runs)
+    gains = np.zeros((2, n_runs))
+    pruned = np.zeros(n_runs, dtype=bool)
     for iteration in range(max_iter):
+        n_active = len(active)
+        active_maps = maps[active]
+
         # Assign each sample to the best matching microstate
-        activation = maps.dot(data)
-        segmentation = np.argmax(np.abs(activation), axis=0)
-        # assigned_activations = np.choose(segmentations, all_activations)
+        activation = np.dot(active_maps.reshape(-1, n_channels), data,
+                            out=activation_buf[:n_active * n_states])
+        activation = activation.reshape(n_active, n_states, n_samples)
+        abs_activation = np.abs(activation,
+                                out=abs_buf[:n_active * n_states].reshape(
+                                    n_active, n_states, n_samples))
+        segmentation = np.argmax(abs_activation, axis=1)
+        assigned = np.take_along_axis(activation, segmentation[:, None],
+                                      axis=1)[:, 0]
 
-        # Recompute the topographic maps of the microstates, based on the
-        # samples that were assigned to each state.
-        for state in range(n_states):
-            idx = (segmentation == state)
-            if np.sum(idx) == 0:
-                warnings.warn('Some microstates are never activated')
-                maps[state] = 0
-                continue
-           
-            # Find largest eigenvector
-            # cov = data[:, idx].dot(data[:, idx].T)
-            # _, vec = eigh(cov, eigvals=(n_channels - 1, n_channels - 1))
-            # maps[state] = vec.ravel()
-            maps[state] = data[:, idx].dot(activation[state, idx])
-            maps[state] /= np.linalg.norm(maps[state])
-
-        # Estimate residual noise
-        act_sum_sq = np.sum((maps[segmentation].T * data) ** 2)
+        # Estimate residual noise from the activations of the current maps
+        act_sum_sq = np.sum(assigned ** 2, axis=1)
         residual = abs(data_sum_sq - act_sum_sq)
         residual /= float(n_samples * (n_channels - 1))
 
         # Have we converged?
-        if (prev_residual - residual) < (thresh * residual):
-            logger.info('Converged at %d iterations.' % iteration)
-            break
+        converged = (prev_residual[active] - residual) < (thresh * residual)
+        prev_residual[active] = residual
+        if np.any(converged):
+            logger.info('%d run(s) converged at %d iterations.' %
+                        (np.sum(converged), iteration))
+            n_iter[active[converged]] = iteration + 1
+
+        # Abandon the runs that cannot catch up with the best one
+        gains[0, active] = gains[1, active]
+        gains[1, active] = act_sum_sq / data_sum_sq - explained[active]
+        explained[active] += gains[1, active]
+        if prune is not None and iteration >= 2:
+            hopeless = _hopeless_runs(explained, gains, active, prune)
+            hopeless &= ~converged
+            for run in active[hopeless]:
+                logger.info('Abandoned run %d at %d iterations: explained '
+                            'variance %f, best %f.' %
+                            (run, iteration, explained[run],
+                             np.max(explained)))
+            n_iter[active[hopeless]] = iteration + 1
+            pruned[active[hopeless]] = True
+            converged |= hopeless
+
+        # Recompute the topographic maps of the microstates, based on the
+        # samples that were assigned to each state. This is a single product
+        # of the data with a one-hot matrix holding the activations of the
+        # assigned states.
+        columns = (segmentation + offsets[:n_active]).T.ravel()
+        assignment = csr_matrix(
+            (assigned.T.ravel(), columns,
+             np.arange(0, n_active * n_samples + 1, n_active)),
+            shape=(n_samples, n_active * n_states))
+        active_maps = (assignment.T @ data_T).reshape(n_active, n_states,
+                                                      n_channels)
+        norms = np.linalg.norm(active_maps, axis=2, keepdims=True)
+        if np.any(norms == 0):
+            warnings.warn('Some microstates are never activated')
+            norms[norms == 0] = 1
+        active_maps /= norms
+        maps[active[~converged]] = active_maps[~converged]
 
-        prev_residual = residual
+        active = active[~converged]
+        if len(active) == 0:
+            break
     else:
         warnings.warn('Modified K-means algorithm failed to converge.')
 
     # Compute final microstate segmentations
-    activation = maps.dot(data)
-    segmentation = np.argmax(activation ** 2, axis=0)
+    activation = maps.reshape(-1, n_channels).dot(data)
+    activation = activation.reshape(n_runs, n_states, n_samples)
+    segmentation = np.argmax(activation ** 2, axis=1)
+
+    return maps, segmentation, n_iter, pruned
+
+
+def _hopeless_runs(explained, gains, active, margin):
+    """Find the active runs of the modified K-means that cannot win.
+
+    The remaining improvement of each run is extrapolated as a geometric
+    series from its last two improvements. A run is hopeless when, with that
+    improvement and the margin, it stays below the run that explains the
+    most variance so far. Since the explained variance of a run never
+    decreases, that best run is certain to end at least that high.
+
+    Returns a boolean mask over the active runs.
+    """
+    previous, last = gains[:, active]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = last / previous
+    # Improvements that do not decrease give no bound
+    remaining = np.where((ratio >= 0) & (ratio < 1),
+                         last * ratio / (1 - ratio), np.inf)
+    remaining[last <= 0] = 0
+    return explained[active] + remaining + margin < np.max(explained)
+
+
+@verbose
+def _aahc(data, n_states, verbose=None):
+    """Atomize and agglomerate hierarchical clustering (AAHC).
+
+    Every sample starts as its own cluster. Repeatedly, the cluster that
+    explains the least variance is atomized: each of its samples joins the
+    cluster whose map has the highest absolute spatial correlation with it.
+    The map of each cluster is the first eigenvector of the scatter matrix
+    of its samples, which is the map that explains most of their variance
+    regardless of polarity. The algorithm is deterministic.
+
+    Only the clusters that received samples are updated after an
+    atomization. The scatter matrix of each cluster is kept, so that the
+    samples it receives are added to it as a low-rank update, and its map
+    and explained variance are the first eigenvector and eigenvalue of the
+    updated matrix. An atomization therefore costs O(n_clusters *
+    n_channels + n_channels ** 2) per atomized sample and O(n_channels **
+    3) per receiving cluster, regardless of the size of the clusters. Only
+    the clusters with more than one sample keep a scatter matrix, which
+    uses O(n_samples * n_channels ** 2) memory at worst.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_samples)
+        The topographies to cluster, for example at the GFP peaks.
+    n_states : list of int
+        The numbers of clusters at which to return the maps.
+    verbose : int | bool | None
+        Controls the verbosity.
+
+    Returns
+    -------
+    maps : dict
+        For each number of clusters, the maps, as an ndarray of shape
+        (n_states, n_channels).
+    """
+    n_channels, n_samples = data.shape
+    data_sq = np.sum(data ** 2, axis=0)
+    norms = np.sqrt(data_sq)
+    maps = data.T / np.where(norms == 0, 1, norms)[:, np.newaxis]
+    scatter = dict()
+    members = [[sample] for sample in range(n_samples)]
+    explained = data_sq.copy()
+    alive = np.ones(n_samples, dtype=bool)
+    n_clusters = n_samples
+
+    logger.info('Agglomerating %d topographies' % n_samples)
+    out = dict()
+    for k in n_states:
+        if k >= n_clusters:
+            out[k] = maps[alive].copy()
+    while n_clusters > min(n_states):
+        # Atomize the cluster that explains the least variance
+        atomized = np.argmin(explained)
+        samples = np.array(members[atomized])
+        alive[atomized] = False
+        explained[atomized] = np.inf
+        members[atomized] = []
+        n_clusters -= 1
+
+        # Its samples join the best matching remaining cluster
+        corr = np.abs(maps.dot(data[:, samples]))
+        corr[~alive] = -1
+        new_labels = np.argmax(corr, axis=0)
+        scatter.pop(atomized, None)
+        for cluster in np.unique(new_labels):
+            received = samples[new_labels == cluster]
+            if cluster not in scatter:
+                # The cluster had a single sample, with no scatter matrix kept
+                sample = data[:, members[cluster][0]]
+                scatter[cluster] = np.outer(sample, sample)
+            members[cluster].extend(received)
+            received_data = data[:, received]
+            scatter[cluster] += received_data.dot(received_data.T)
+            eigenvalues, eigenvectors = np.linalg.eigh(scatter[cluster])
+            maps[cluster] = eigenvectors[:, -1]
+            explained[cluster] = eigenvalues[-1]
+
+        if n_clusters in n_states:
+            out[n_clusters] = maps[alive].copy()
+            logger.info('%d clusters: %f of the variance explained' %
+                        (n_clusters, np.sum(explained[alive]) /
+                         np.sum(data_sq)))
+
+        # Drop the atomized clusters, to keep the matching proportional to
+        # the number of remaining clusters
+        if n_clusters < len(alive) // 2:
+            keep = np.flatnonzero(alive)
+            maps, explained = maps[keep], explained[keep]
+            members = [members[cluster] for cluster in keep]
+            scatter = dict((new, scatter[old]) for new, old in enumerate(keep)
+                           if old in scatter)
+            alive = alive[keep]
+    return out
+
+
+def _check_method(method):
+    """Check the clustering method."""
+    if method not in ('kmeans', 'aahc'):
+        raise ValueError("method must be 'kmeans' or 'aahc', got %r"
+                         % (method,))
+
+
+def _check_init(init):
+    """Check the initialization method of the modified K-means."""
+    if init not in ('random', 'k-means++'):
+        raise ValueError("init must be 'random' or 'k-means++', got %r"
+                         % (init,))
+
+
+def _kmeans_plusplus(data, n_states, seeds):
+    """Choose the initial maps of the modified K-means with k-means++.
+
+    For each seed, the maps are chosen one by one among the samples. Each
+    sample is chosen with a probability proportional to its residual
+    variance given the maps chosen so far, which is its squared norm times
+    one minus its squared spatial correlation with the closest map. The
+    polarity of the maps is thus ignored, as in the modified K-means. The
+    residuals of all runs are updated together, with one matrix product per
+    state.
+
+    Returns
+    -------
+    maps : ndarray, shape (n_runs, n_states, n_channels)
+        For each run, the chosen samples (not normalized).
+    """
+    n_channels, n_samples = data.shape
+    random_states = [np.random.RandomState(seed) for seed in seeds]
+    maps = np.empty((len(seeds), n_states, n_channels))
+    data_sq = np.sum(data ** 2, axis=0)
+    residual = np.tile(data_sq, (len(seeds), 1))
+    for state in range(n_states):
+        for run, random_state in enumerate(random_states):
+            total = np.sum(residual[run])
+            if total > 0:
+                # Cumulative sums rather than random_state.choice(p=...),
+                # which is slower and rejects rounding errors in p.
+                cumulative = np.cumsum(residual[run])
+                sample = np.searchsorted(cumulative,
+                                         random_state.uniform(0, total),
+                                         side='right')
+                sample = min(sample, n_samples - 1)
+            else:
+                sample = random_state.randint(n_samples)
+            maps[run, state] = data[:, sample]
+        norms = np.linalg.norm(maps[:, state], axis=1, keepdims=True)
+        unit = maps[:, state] / np.where(norms == 0, 1, norms)
+        np.minimum(residual, data_sq - unit.dot(data) ** 2, out=residual)
+        np.maximum(residual, 0, out=residual)
+    return maps
+
+
+def smooth_segmentation(data, maps, segmentation, width=3, smooth_lambda=5.,
+                        max_iter=1000, thresh=1e-6):
+    """Smooth a segmentation in time with a sliding window.
+
+    This is the windowed smoothing of Pascual-Marqui et al. (1995) [1]_.
+    Each sample is assigned to the microstate that minimizes its residual
+    variance, penalized by ``smooth_lambda`` times the number of other
+    samples in a window of ``width`` samples on either side that have that
+    label. The counts for all samples are computed at once with cumulative
+    sums, so each iteration costs O(n_samples * n_states).
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_samples)
+        The segmented data.
+    maps : ndarray, shape (n_states, n_channels)
+        The topographic maps of the microstates.
+    segmentation : ndarray of int, shape (n_samples,)
+        The segmentation to smooth, for example from :func:`backfit`.
+    width : int
+        The half-width of the window in samples. Defaults to 3.
+    smooth_lambda : float
+        The smoothness penalty. Larger values give longer segments. Defaults
+        to 5.
+    max_iter : int
+        The maximum number of iterations. Defaults to 1000.
+    thresh : float
+        The threshold of convergence, based on the relative change in
+        residual variance. Defaults to 1e-6.
+
+    Returns
+    -------
+    segmentation : ndarray of int, shape (n_samples,)
+        The smoothed segmentation.
+
+    References
+    ----------
+    .. [1] Pascual-Marqui, R. D., Michel, C. M., & Lehmann, D. (1995).
+           Segmentation of brain electrical activity into microstates: model
+           estimation and validation. IEEE Transactions on Biomedical
+           Engineering.
+    """
+    act_sq, data_sq = _activations(data, maps)
+    return _smooth_labels(act_sq, data_sq, segmentation, data.shape[0], width,
+                          smooth_lambda, max_iter, thresh)
+
+
+def _smooth_labels(act_sq, data_sq, segmentation, n_channels, width,
+                   smooth_lambda, max_iter, thresh):
+    """Windowed smoothing of a segmentation, from the squared activations.
+
+    See :func:`smooth_segmentation` for the parameters.
+    """
+    n_states, n_samples = act_sq.shape
+    samples = np.arange(n_samples)
+    residual = data_sq - act_sq
+    labels = np.asarray(segmentation).copy()
+
+    # The noise variance of the initial segmentation scales the residuals
+    noise_var = np.mean(residual[labels, samples]) / (n_channels - 1)
+    cost_scale = 1. / (2 * noise_var * (n_channels - 1))
+
+    lower = np.maximum(samples - width, 0)
+    upper = np.minimum(samples + width + 1, n_samples)
+    one_hot = np.zeros((n_states, n_samples + 1))
+    prev_residuals = [np.inf, np.inf]
+    for iteration in range(max_iter):
+        # Number of samples with each label in the window around each sample
+        one_hot[:, 1:] = 0
+        one_hot[labels, samples + 1] = 1
+        counts = np.cumsum(one_hot, axis=1)
+        counts = counts[:, upper] - counts[:, lower]
+        counts[labels, samples] -= 1
+
+        labels = np.argmin(residual * cost_scale - smooth_lambda * counts,
+                           axis=0)
+        # All samples are updated at once, so a few samples can flip back
+        # and forth between two labels. A residual equal to that of two
+        # iterations ago also ends the iterations.
+        total_residual = np.sum(residual[labels, samples])
+        if any(abs(prev - total_residual) < thresh * total_residual
+               for prev in prev_residuals):
+            logger.info('Smoothing converged at %d iterations.' % iteration)
+            break
+        prev_residuals = [total_residual, prev_residuals[0]]
+    else:
+        warnings.warn('Smoothing of the segmentation failed to converge.')
+    return labels
+
+
+def reject_short_segments(segmentation, min_length):
+    """Reassign segments that are too short to their neighbours.
+
+    Segments are handled from the shortest to the longest. The first half
+    of a short segment is given the label of the previous segment and the
+    second half the label of the next one. A short segment at either end of
+    the segmentation is merged with its only neighbour.
+
+    Parameters
+    ----------
+    segmentation : ndarray of int, shape (n_samples,)
+        For each sample, the index of its microstate.
+    min_length : int
+        The minimum length of a segment in samples.
+
+    Returns
+    -------
+    segmentation : ndarray of int, shape (n_samples,)
+        The segmentation without segments shorter than ``min_length``.
+    """
+    segmentation = np.asarray(segmentation).copy()
+    for length in range(1, min_length):
+        while True:
+            labels, starts, lengths = run_lengths(segmentation)
+            if len(labels) < 2:
+                return segmentation
+            short = np.flatnonzero(lengths == length)
+            if len(short) == 0:
+                break
+            # Runs next to another short run are handled in the next pass
+            short = short[np.diff(short, prepend=-2) > 1]
+
+            prev_labels = labels[np.maximum(short - 1, 0)]
+            next_labels = labels[np.minimum(short + 1, len(labels) - 1)]
+            prev_labels[short == 0] = next_labels[short == 0]
+            next_labels[short == len(labels) - 1] = \
+                prev_labels[short == len(labels) - 1]
+
+            offsets = np.tile(np.arange(length), len(short))
+            positions = np.repeat(starts[short], length) + offsets
+            segmentation[positions] = np.where(
+                offsets < length // 2, np.repeat(prev_labels, length),
+                np.repeat(next_labels, length))
+    return segmentation
+
+
+def run_lengths(segmentation):
+    """Run-length encode a segmentation.
+
+    Parameters
+    ----------
+    segmentation : array-like of int, shape (n_samples,)
+        For each sample, the index of its microstate.
+
+    Returns
+    -------
+    labels : ndarray of int, shape (n_runs,)
+        The microstate of each run.
+    starts : ndarray of int, shape (n_runs,)
+        The index of the first sample of each run.
+    lengths : ndarray of int, shape (n_runs,)
+        The number of samples of each run.
+    """
+    segmentation = np.asarray(segmentation)
+    if len(segmentation) == 0:
+        empty = np.empty(0, dtype=int)
+        return empty, empty, empty
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(segmentation)) + 1))
+    lengths = np.diff(np.append(starts, len(segmentation)))
+    return segmentation[starts], starts, lengths
+
+
+def normalize_templates(maps):
+    """Prepare microstate maps for use with :func:`match_templates`.
+
+    Parameters
+    ----------
+    maps : ndarray, shape (n_states, n_channels)
+        The topographic maps of the microstates.
+
+    Returns
+    -------
+    templates : ndarray, shape (n_states, n_channels)
+        The maps, centered across channels and scaled to unit norm.
+    """
+    templates = maps - np.mean(maps, axis=1, keepdims=True)
+    templates /= np.linalg.norm(templates, axis=1, keepdims=True)
+    return templates
+
+
+def match_templates(data, templates):
+    """Assign each sample to the template with the best spatial correlation.
+
+    The absolute value of the correlation is used, so the polarity of the
+    maps is ignored. Since the templates are centered, the correlation with
+    all templates is obtained with a single matrix product, without
+    centering the data.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_samples)
+        The samples or topographies to label.
+    templates : ndarray, shape (n_states, n_channels)
+        The templates, as returned by :func:`normalize_templates`.
+
+    Returns
+    -------
+    labels : ndarray, shape (n_samples,)
+        For each sample, the index of the best matching template.
+    corr : ndarray, shape (n_samples,)
+        For each sample, the absolute correlation with the best matching
+        template.
+    """
+    activation = np.abs(templates.dot(data))
+    labels = np.argmax(activation, axis=0)
+    corr = activation[labels, np.arange(len(labels))]
+    norms = np.linalg.norm(data - np.mean(data, axis=0), axis=0)
+    corr /= np.where(norms == 0, np.inf, norms)
+    return labels, corr
+
+
+def _gfp(data):
+    """Compute the global field power (GFP): the spatial standard deviation.
 
-    return maps, segmentation
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_samples)
+        The data.
+
+    Returns
+    -------
+    gfp : ndarray, shape (n_samples,)
+        The GFP of each sample.
+    """
+    return np.std(data, axis=0)
+
+
+def _gev(data, maps, segmentation, gfp):
+    """Compute the global explained variance (GEV) of a segmentation.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_samples)
+        The segmented data.
+    maps : ndarray, shape (n_states, n_channels)
+        The topographic maps of the microstates.
+    segmentation : ndarray, shape (n_samples,)
+        For each sample, the index of the assigned microstate.
+    gfp : ndarray, shape (n_samples,)
+        The global field power of the data.
+
+    Returns
+    -------
+    gev : float
+        The global explained variance.
+    """
+    map_corr = _corr_vectors(data, maps[segmentation].T)
+    return np.sum((gfp * map_corr) ** 2) / np.sum(gfp ** 2)
 
 
 def _corr_vectors(A, B, axis=0):
@@ -227,7 +1399,7 @@ def plot_segmentation(segmentation, data, times):
     times : list of float
         The time-stamp for each sample.
     """
-    gfp = np.mean(data ** 2, axis=0)
+    gfp = _gfp(data)
 
     n_states = len(np.unique(segmentation))
     plt.figure(figsize=(6 * np.ptp(times), 2))
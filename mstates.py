@@ -1,6 +1,7 @@
 import mne
 import microstates
 import numpy as np
+from templates import Templates
 import matplotlib.pyplot as plt
 
 subj = 1
@@ -29,13 +30,13 @@ def myplot_maps(maps, info):
 
 if subj == 1:
     raw = mne.io.read_raw_brainvision("../s1/BrainVision/20191029-134633-raw.Export.clean.vhdr", preload=True)
-    outfile = "Maps_4states_s1.txt"
+    outfile = "Maps_4states_s1.npz"
 elif subj == 2:
     raw = mne.io.read_raw_brainvision("../S2 clean data/20191029-140241-raw.FinalClean.vhdr", preload=True)
-    outfile = "Maps_4states_s2.txt"
+    outfile = "Maps_4states_s2.npz"
 elif subj ==3:
     raw = mne.io.read_raw_brainvision("../s3 clean data/20191029-141906-raw.CleanCleanClean.vhdr", preload=True)
-    outfile = "Maps_4states_s3.txt"
+    outfile = "Maps_4states_s3.npz"
 
 raw.set_montage('standard_1005')
 #raw.plot_sensors(show_names=True)
@@ -59,8 +60,15 @@ raw.filter(0.2, None)
 # use only EEG channels
 raw.pick_types(meg=False, eeg=True)
 
+# Normalize each channel here rather than in segment, to store the scaling with the templates
+data = raw.get_data()
+scaling = None
+if normalize:
+    scaling = (np.mean(data, axis=1), np.std(data, axis=1))
+    data = (data - scaling[0][:, np.newaxis]) / scaling[1][:, np.newaxis]
+
 # Segment the data into 6 microstates
-maps, segmentation = microstates.segment(raw.get_data(), n_states=nstates, max_n_peaks=10000000000, max_iter=5000, normalize=normalize)
+maps, segmentation, gev = microstates.segment(data, n_states=nstates, max_n_peaks=10000000000, max_iter=5000, return_gev=True)
 
 # Plot the topographic maps of the found microstates
 #microstates.plot_maps(maps, raw.info)
@@ -71,4 +79,4 @@ cutpoint = 5000
 microstates.plot_segmentation(segmentation[cutpoint-1000:cutpoint], raw.get_data()[:, cutpoint-1000:cutpoint], raw.times[cutpoint-1000:cutpoint])
 plt.show()
 
-np.savetxt(outfile, maps, delimiter=" ")
+Templates(maps, raw.ch_names, raw.info['sfreq'], 0.2, None, gev, scaling).save(outfile)
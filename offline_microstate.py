@@ -24,6 +24,8 @@ from neurodecode.protocols.viz_bars import BarVisual
 from neurodecode.triggers.trigger_def import trigger_def
 from neurodecode.gui.streams import redirect_stdout_to_queue
 
+from session import session_control
+
 #----------------------------------------------------------------------
 def check_config(cfg):
     """
@@ -64,20 +66,18 @@ def run(cfg, state=mp.Value('i', 1), queue=None):
         '[':91, ']':93, '1':49, '!':33, '2':50, '@':64, '3':51, '#':35}
     
     redirect_stdout_to_queue(logger, queue, 'INFO')
+    session = session_control(state)
     
     # Wait the recording to start (GUI)
-    while state.value == 2: # 0: stop, 1:start, 2:wait
-        pass
-
     # Protocol runs if state equals to 1
-    if not state.value:
+    if not session.wait_for_start():
         sys.exit(-1)
     
     global_timer = qc.Timer(autoreset=False)
     
     # Init trigger communication
     cfg.tdef = trigger_def(cfg.TRIGGER_FILE)
-    trigger = pyLptControl.Trigger(state, cfg.TRIGGER_DEVICE)
+    trigger = pyLptControl.Trigger(session.state, cfg.TRIGGER_DEVICE)
     if trigger.init(50) == False:
         logger.error('\n** Error connecting to trigger device.')
         raise RuntimeError
@@ -97,7 +97,7 @@ def run(cfg, state=mp.Value('i', 1), queue=None):
     
     # Wait a key press
     key = 0xFF & cv2.waitKey(0)
-    if key == keys['esc'] or not state.value:
+    if key == keys['esc'] or not session.running:
         sys.exit(-1)
     
     viz.fill()
@@ -109,15 +109,22 @@ def run(cfg, state=mp.Value('i', 1), queue=None):
     #----------------------------------------------------------------------        
     trigger.signal(cfg.tdef.INIT)
     
-    while state.value == 1 and global_timer.sec() < cfg.GLOBAL_TIME:
+    # Sleep until the end of the recording, a key press or a stop. The
+    # window needs cv2.waitKey to process its events; it blocks until a key
+    # is pressed or a slice of at most 100 ms has passed.
+    while session.running and global_timer.sec() < cfg.GLOBAL_TIME:
         
-        key = cv2.waitKey(1)
+        remaining = cfg.GLOBAL_TIME - global_timer.sec()
+        key = 0xFF & cv2.waitKey(max(1, int(1000 * min(remaining, 0.1))))
         if key == keys['esc']:
-            with state.get_lock():
-                state.value = 0
+            session.stop()
                 
     trigger.signal(cfg.tdef.END)
     
+    if session.aborted:
+        viz.finish()
+        sys.exit(-1)
+    
     # Remove the text
     viz.fill()
     viz.put_text('Recording is finished')
@@ -9,15 +9,22 @@
 import mne
 import os
 import sys
-import time
 import numpy as np
 import multiprocessing as mp
 
 from importlib import import_module
-from scipy.signal import argrelextrema, detrend
 
 import matplotlib.pyplot as plt
 
+from latency import LatencyMonitor
+from renderer import FeedbackRenderer
+from replay import ReplayReceiver
+from scheduler import HopScheduler
+from session import session_control
+from stats import OnlineStats
+from streaming import OnlinePreprocessor, OnlineSegmenter
+from templates import read_templates
+
 import neurodecode.utils.pycnbi_utils as pu
 
 from neurodecode import logger
@@ -43,6 +50,20 @@ def check_config(cfg):
         'AMP_SERIAL':None,
         'GLOBAL_TIME': 1.0 * 60,
         'NJOBS': 1,
+        'TEMPLATE_FILE': './Maps_4states_s2.npz',
+        'MIN_PEAK_DIST': 2,
+        'PEAK_LOOKAHEAD': None,
+        'FPS': 60,
+        'LATENCY_FILE': None,
+        'REPLAY_FILE': None,
+        'REPLAY_SPEED': 1.0,
+        'REPLAY_JITTER': 0,
+        'REPLAY_DROP_RATE': 0,
+        'HOP_MS': 50,
+        'FEEDBACK_WINDOW': None,
+        'FEEDBACK_METRIC': 'coverage',
+        'FEEDBACK_MAX': None,
+        'MIN_SEGMENT_MS': None,
     }
 
     for key in critical_vars['COMMON']:
@@ -92,46 +113,27 @@ def run(cfg, state=mp.Value('i', 1), queue=None):
     Online protocol for Alpha/Theta neurofeedback.
     """
     redirect_stdout_to_queue(logger, queue, 'INFO')
+    session = session_control(state)
 
     # Wait the recording to start (GUI)
-    while state.value == 2: # 0: stop, 1:start, 2:wait
-        pass
-
     # Protocol runs if state equals to 1
-    if not state.value:
+    if not session.wait_for_start():
         sys.exit(-1)
 
-#----------------------------------------------------------------------
-
-def print_perc(percent):
-    white = (255, 255, 255)
-    # create a font object.
-    # 1st parameter is the font file
-    # which is present in pygame.
-    # 2nd parameter is size of the font
-    font = pygame.font.Font('freesansbold.ttf', 22)
-
-    # create a text suface object,
-    # on which text is drawn on it.
-    text = font.render(str(percent/10) + '%', True,white)
-
-    # create a rectangular object for the
-    # text surface object
-    textRect = text.get_rect()
-
-    # set the center of the rectangular object.
-    textRect.center = (w // 4, h // 4)
-
-    screen.blit(text,textRect)
-
     #----------------------------------------------------------------------
     # LSL stream connection
     #----------------------------------------------------------------------
-    # chooose amp
-    amp_name, amp_serial = find_lsl_stream(cfg, state)
+    if cfg.REPLAY_FILE is None:
+        # chooose amp
+        amp_name, amp_serial = find_lsl_stream(cfg, state)
 
-    # Connect to lsl stream
-    sr = connect_lsl_stream(cfg, amp_name, amp_serial)
+        # Connect to lsl stream
+        sr = connect_lsl_stream(cfg, amp_name, amp_serial)
+    else:
+        # Replay a recording instead of the amplifier
+        logger.info('Replaying %s at speed %s' % (cfg.REPLAY_FILE, cfg.REPLAY_SPEED))
+        sr = ReplayReceiver(cfg.REPLAY_FILE, speed=cfg.REPLAY_SPEED, jitter=cfg.REPLAY_JITTER,
+                            drop_rate=cfg.REPLAY_DROP_RATE, window_size=cfg.WINDOWSIZE)
 
     # Get sampling rate
     sfreq = sr.get_sample_rate()
@@ -139,6 +141,43 @@ def print_perc(percent):
     # Get trigger channel
     trg_ch = sr.get_trigger_channel()
 
+    #----------------------------------------------------------------------
+    # Microstates
+    #----------------------------------------------------------------------
+    # Loaded once, the normalized maps are kept in memory
+    templates = read_templates(cfg.TEMPLATE_FILE)
+
+    # Pick the channels of the templates and filter them as the training data,
+    # carrying the filter state from one chunk to the next
+    preprocessor = OnlinePreprocessor.from_templates(templates, sr.get_channel_names(), sfreq, trigger=trg_ch)
+
+    # Per-stage timing of each update, kept in preallocated buffers
+    monitor = LatencyMonitor(['acquire', 'preprocess', 'buffer', 'gfp', 'peaks', 'match', 'label', 'publish'])
+
+    # Duration, occurrence and coverage of the microstates over the feedback window
+    if cfg.FEEDBACK_METRIC not in ('coverage', 'mean_duration', 'occurrence'):
+        logger.error('FEEDBACK_METRIC must be coverage, mean_duration or occurrence')
+        raise RuntimeError
+    if cfg.FEEDBACK_METRIC != 'coverage' and cfg.FEEDBACK_MAX is None:
+        logger.error('FEEDBACK_MAX is required for FEEDBACK_METRIC=%s' % cfg.FEEDBACK_METRIC)
+        raise RuntimeError
+    feedback_window = cfg.WINDOWSIZE if cfg.FEEDBACK_WINDOW is None else cfg.FEEDBACK_WINDOW
+    stats = OnlineStats(templates.n_states, sfreq, window=int(feedback_window * sfreq))
+
+    # Incremental labelling over a ring buffer spanning the feedback window
+    segmenter = OnlineSegmenter(templates.normalized, int(feedback_window * sfreq), cfg.MICRO2REGULATE,
+                                min_peak_dist=cfg.MIN_PEAK_DIST, lookahead=cfg.PEAK_LOOKAHEAD,
+                                monitor=monitor, stats=stats,
+                                min_segment_length=None if cfg.MIN_SEGMENT_MS is None else
+                                int(round(cfg.MIN_SEGMENT_MS / 1000. * sfreq)))
+    logger.info('GFP peaks are confirmed %d samples (%.1f ms) after they occur.' %
+                (segmenter.detector.lookahead, segmenter.detector.lookahead / sfreq * 1000))
+
+    #----------------------------------------------------------------------
+    # Feedback
+    #----------------------------------------------------------------------
+    renderer = FeedbackRenderer(fps=cfg.FPS)
+    renderer.start()
 
     #----------------------------------------------------------------------
     # Main
@@ -146,98 +185,63 @@ def print_perc(percent):
     global_timer = qc.Timer(autoreset=False)
     internal_timer = qc.Timer(autoreset=True)
 
-    while state.value == 1 and global_timer.sec() < cfg.GLOBAL_TIME:
+    # Feedback at a fixed cadence, over the trailing feedback window
+    scheduler = HopScheduler(None if cfg.HOP_MS is None else cfg.HOP_MS / 1000.)
+    logger.info('Feedback every %s ms over the last %.2f s.' % (cfg.HOP_MS, feedback_window))
+
+    while session.running and global_timer.sec() < cfg.GLOBAL_TIME and renderer.is_alive():
+        # Wait for the next hop, or until the session is stopped
+        if scheduler.wait(session.wait_for_stop):
+            break
+        monitor.begin()
 
         #----------------------------------------------------------------------
         # Data acquisition
         #----------------------------------------------------------------------
-        sr.acquire()
-        raw, tslist = sr.get_window()       # [samples x channels]
-        raw = raw.T                         # [channels x samples]
-
-        # Check if proper real-time acquisition
-        tsnew = np.where(np.array(tslist) > last_ts)[0]
-        if len(tsnew) == 0:
-            logger.warning('There seems to be delay in receiving data.')
-            time.sleep(1)
-            continue
+        raw, tslist = sr.acquire()          # [samples x channels]
+        monitor.mark('acquire')
 
         #----------------------------------------------------------------------
         # Data processing
         #----------------------------------------------------------------------
 
-        # Compute the GFP
-        gfp = np.abs(detrend(np.mean(raw, 0)))    # [1 x samples]
-
-        # Find GFP's peak
-        gfp_peaks = argrelextrema(gfp, np.greater, order=15)     # Order needs to be optimized
-
-        # Assign dominant microstate
-        count = 0
-
-
-        micro_template = np.loadtxt("./Maps_4states_s2.txt", dtype=float)
-
-        #  Missing first and last microstate --> TO change
-        for p in range(1, len(gfp_peaks[0])-1):
-            correletion = np.array()
-
-            for i in range(len(micro_template)):
-                correletion.append(np.corrcoef(raw[:, p], micro_template[i]))
-
-            if np.argmax(correletion) == cfg.MICRO2REGULATE:
-                start = gfp_peaks[0][p - 1] + (gfp_peaks[0][p] - gfp_peaks[0][p-1]) / 2
-                end = gfp_peaks[0][p] + (gfp_peaks[0][p+1] - gfp_peaks[0][p]) / 2
-                count = count + len(range(start, end))
-
-        # Percentage of the microstate of interest
-        percent = count / raw.shape[1] * 100
+        # Only the samples newer than the previous update are processed
+        raw, tslist = preprocessor.process(raw.T, tslist)  # [channels x samples]
+        monitor.mark('preprocess')
+        n_new = segmenter.update(raw, tslist)
 
-        # Feedback
-        
-        pygame.init()
-
-        pygame.display.set_caption('EEG microstate')
-
-        background = pygame.image.load('stars2.png')
-
-        background_size = background.get_size()
-        background_rect = background.get_rect()
-        screen = pygame.display.set_mode(background_size)
-        w,h = background_size
-
-        x = 0
-        y = 0
+        # Check if proper real-time acquisition
+        if n_new == 0:
+            if isinstance(sr, ReplayReceiver) and sr.finished:
+                logger.info('End of the replay.')
+                break
+            logger.warning('There seems to be delay in receiving data.')
+            if not scheduler.hop:
+                session.wait_for_stop(timeout=1)
+            continue
 
-        x1 = 0
-        y1 = -h
+        # Percentage of the microstate of interest, or of the target duration/occurrence
+        if cfg.FEEDBACK_METRIC == 'coverage':
+            percent = segmenter.percent
+        else:
+            value = getattr(stats, cfg.FEEDBACK_METRIC)[cfg.MICRO2REGULATE]
+            percent = 0. if np.isnan(value) else min(100., 100. * value / cfg.FEEDBACK_MAX)
 
-        ship = pygame.image.load("space.png")
-        shiprect = ship.get_rect()
-        shiprect.center = (w//2,h//2)
-        running = True
-        i = 0
+        # Feedback, drawn by the renderer at its own pace
+        renderer.update(percent, monitor.n_updates, segmenter.last_ts)
+        monitor.mark('publish')
+        monitor.end(n_new, segmenter.last_ts)
 
-        # set the pygame window name
-        pygame.display.set_caption('EEG microstate')
-        screen.blit(background,background_rect)
+    renderer.stop()
 
-        for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    running = False
-        y1 += percent
-        y += percent
-        screen.blit(background,(x,y))
-        screen.blit(background,(x1,y1))
-        if y > h:
-            y = -h
-        if y1 > h:
-            y1 = -h
-            
-        screen.blit(ship,shiprect)
-        print_perc(percent)
-        pygame.display.flip()
-        pygame.display.update()
+    #----------------------------------------------------------------------
+    # Latency report
+    #----------------------------------------------------------------------
+    scheduler.log_summary()
+    monitor.add_display(*renderer.get_flips())
+    monitor.log_summary()
+    if cfg.LATENCY_FILE is not None:
+        monitor.save(cfg.LATENCY_FILE)
 
 
 # ----------------------------------------------------------------------
@@ -0,0 +1,184 @@
+"""
+Feedback display for the online microstate protocol.
+
+The display runs in its own process, at a fixed frame rate, so drawing never
+delays the processing of the EEG. The processing loop only writes the latest
+feedback value into shared memory, without locking. The display records when
+it first showed each feedback update, to measure the feedback latency.
+"""
+import multiprocessing as mp
+import numpy as np
+
+from neurodecode import logger
+
+
+class FeedbackRenderer(object):
+    """Starfield feedback display running in its own process.
+
+    A space ship flies over a scrolling starfield. The scroll speed follows
+    the latest feedback value, and the value itself is printed on screen.
+
+    Parameters
+    ----------
+    fps : int
+        The frame rate of the display. Defaults to 60.
+    speed : float
+        The scroll speed in pixels per second when the feedback value is 100.
+        Defaults to 300.
+    background : str
+        The image of the starfield. Defaults to ``'stars2.png'``.
+    ship : str
+        The image of the space ship. Defaults to ``'space.png'``.
+    caption : str
+        The title of the window. Defaults to ``'EEG microstate'``.
+    n_flips : int
+        The number of displayed updates to record. Older records are
+        overwritten. Defaults to 100000.
+    """
+    def __init__(self, fps=60, speed=300., background='stars2.png',
+                 ship='space.png', caption='EEG microstate', n_flips=100000):
+        # Version counter, feedback value, sequence number of the update and
+        # timestamp of its newest sample. The counter is odd while writing.
+        self._shared = mp.RawArray('d', 4)
+        self._shared[2] = -1
+        # Sequence number and flip time of each displayed update
+        self._flips = mp.RawArray('d', 2 * n_flips)
+        self._n_flips = mp.RawValue('l', 0)
+        self._stop = mp.Event()
+        self._process = mp.Process(
+            target=_render_loop, args=(self._shared, self._flips,
+                                       self._n_flips, self._stop, fps, speed,
+                                       background, ship, caption),
+            daemon=True)
+
+    def start(self):
+        """Open the display and start drawing."""
+        self._process.start()
+
+    def update(self, value, seq=-1, sample_ts=np.nan):
+        """Publish a new feedback value, without waiting for the display.
+
+        Parameters
+        ----------
+        value : float
+            The feedback value, as a percentage.
+        seq : int
+            The sequence number of the update, to find its flip time with
+            :meth:`get_flips`. Defaults to -1, in which case the flip is not
+            recorded.
+        sample_ts : float
+            The LSL timestamp of the newest sample the value was computed
+            from. Defaults to NaN.
+        """
+        shared = self._shared
+        shared[0] += 1
+        shared[1] = value
+        shared[2] = seq
+        shared[3] = sample_ts
+        shared[0] += 1
+
+    def get_flips(self):
+        """Get the time at which each recorded update was first displayed.
+
+        Returns
+        -------
+        seqs : ndarray of int, shape (n_flips,)
+            The sequence numbers of the displayed updates. Updates that were
+            replaced before the next frame are never displayed.
+        flip_ts : ndarray, shape (n_flips,)
+            For each update, the LSL time of the first display flip showing
+            it.
+        """
+        flips = np.frombuffer(self._flips).reshape(-1, 2)
+        n = min(self._n_flips.value, len(flips))
+        flips = flips[:n]
+        return flips[:, 0].astype(int), flips[:, 1].copy()
+
+    def is_alive(self):
+        """Whether the display is still open."""
+        return self._process.is_alive()
+
+    def stop(self, timeout=5):
+        """Close the display.
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum time to wait for the display to close, in seconds.
+            Defaults to 5.
+        """
+        self._stop.set()
+        self._process.join(timeout)
+        if self._process.is_alive():
+            logger.warning('The feedback display did not close, '
+                           'terminating it.')
+            self._process.terminate()
+
+
+def _read_shared(shared):
+    """Read the published update, retrying while it is being written."""
+    while True:
+        version = shared[0]
+        value, seq, sample_ts = shared[1], shared[2], shared[3]
+        if version % 2 == 0 and shared[0] == version:
+            return value, int(seq), sample_ts
+
+
+def _render_loop(shared, flips, n_flips, stop, fps, speed, background, ship,
+                 caption):
+    """Draw the feedback at a fixed frame rate until asked to stop."""
+    import pygame
+    from pylsl import local_clock
+
+    pygame.init()
+    pygame.display.set_caption(caption)
+
+    # Load the assets once, converted to the pixel format of the display
+    background = pygame.image.load(background)
+    w, h = background.get_size()
+    screen = pygame.display.set_mode((w, h))
+    background = background.convert()
+    ship = pygame.image.load(ship).convert_alpha()
+    shiprect = ship.get_rect()
+    shiprect.center = (w // 2, h // 2)
+    font = pygame.font.Font('freesansbold.ttf', 22)
+    white = (255, 255, 255)
+
+    clock = pygame.time.Clock()
+    y = 0.
+    shown = None
+    shown_seq = -1
+    max_flips = len(flips) // 2
+    while not stop.is_set():
+        # Move according to the time elapsed, so the scroll stays smooth when
+        # frames or feedback updates are irregular.
+        dt = clock.tick(fps) / 1000.
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                stop.set()
+
+        percent, seq, sample_ts = _read_shared(shared)
+        y = (y + speed * percent / 100. * dt) % h
+        screen.blit(background, (0, y))
+        screen.blit(background, (0, y - h))
+        screen.blit(ship, shiprect)
+
+        # Only render the text again when the value changed
+        if percent != shown:
+            shown = percent
+            text = font.render('%.1f%%' % percent, True, white)
+            textrect = text.get_rect()
+            textrect.center = (w // 4, h // 4)
+        screen.blit(text, textrect)
+        pygame.display.flip()
+
+        # Record when each update was first shown
+        if seq != shown_seq:
+            shown_seq = seq
+            if seq >= 0:
+                i = n_flips.value % max_flips
+                flips[2 * i] = seq
+                flips[2 * i + 1] = local_clock()
+                n_flips.value += 1
+
+    pygame.quit()
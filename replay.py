@@ -0,0 +1,285 @@
+"""
+Replay of a recording in place of a live amplifier.
+
+:class:`ReplayReceiver` streams a BrainVision recording, chunk by chunk, and
+offers the methods of the neurodecode ``StreamReceiver`` used by the
+protocols. The recording can be played in real time, N times faster or as
+fast as possible, with jitter on the arrival of the chunks and dropped
+chunks. :func:`stream_lsl` publishes the same replay on an LSL outlet
+instead, for use by other programs. This allows running and benchmarking
+the online pipeline without an amplifier, and checking its labels against
+offline back-fitting with :func:`compare_with_backfit`.
+"""
+import time
+import numpy as np
+from scipy.signal import find_peaks
+import mne
+from mne.utils import logger, verbose
+
+from microstates import backfit, match_templates, normalize_templates, _gfp
+from streaming import OnlineSegmenter
+
+try:
+    from pylsl import local_clock
+except ImportError:
+    local_clock = time.perf_counter
+
+
+class ReplayReceiver(object):
+    """Stream a recording as if it came from an amplifier.
+
+    The data is split in chunks of ``chunk_size`` samples. Each chunk
+    arrives when its last sample would have been recorded, delayed by a
+    random jitter. Like the LSL timestamps of a live stream, the timestamps
+    of the samples are on the clock of :func:`pylsl.local_clock`.
+
+    Parameters
+    ----------
+    raw : str | instance of Raw
+        The recording, or the name of a BrainVision ``.vhdr`` file.
+    speed : float | None
+        The playback speed, relative to real time. Defaults to 1. Set to
+        ``None`` to play as fast as possible: each call to :meth:`acquire`
+        then returns the next chunk without waiting.
+    chunk_size : int
+        The number of samples per chunk. Defaults to 16.
+    jitter : float
+        The maximum delay in seconds added to the arrival of each chunk,
+        drawn uniformly. Chunks still arrive in order. Defaults to 0.
+    drop_rate : float
+        The probability that a chunk is lost. Its samples are never
+        returned. Defaults to 0.
+    window_size : float
+        The length in seconds of the data returned by :meth:`get_window`.
+        Defaults to 2.
+    random_state : int | numpy.random.RandomState | None
+        The seed or ``RandomState`` for the jitter and the dropped chunks.
+        Defaults to ``None``.
+
+    Attributes
+    ----------
+    n_samples : int
+        The number of samples of the recording.
+    finished : bool
+        Whether all chunks have been returned.
+    """
+    def __init__(self, raw, speed=1., chunk_size=16, jitter=0., drop_rate=0.,
+                 window_size=2., random_state=None):
+        if isinstance(raw, str):
+            raw = mne.io.read_raw_brainvision(raw, preload=True)
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+
+        # The trigger channel comes first, as in the neurodecode streams
+        events, _ = mne.events_from_annotations(raw, verbose=False)
+        trigger = np.zeros(raw.n_times)
+        trigger[events[:, 0] - raw.first_samp] = events[:, 2]
+        self._data = np.vstack((trigger, raw.get_data())).T
+        self._ch_names = ['TRIGGER'] + raw.ch_names
+        self.sfreq = raw.info['sfreq']
+        self.n_samples = raw.n_times
+        self.speed = speed
+        self.chunk_size = chunk_size
+        self._n_window = int(round(window_size * self.sfreq))
+
+        # Arrival time of each chunk in seconds after the start of the replay
+        self._stops = np.append(np.arange(chunk_size, self.n_samples,
+                                          chunk_size), self.n_samples)
+        n_chunks = len(self._stops)
+        if speed is None:
+            self._arrivals = np.zeros(n_chunks)
+        else:
+            self._arrivals = self._stops / (self.sfreq * speed)
+            self._arrivals += random_state.uniform(0, jitter, size=n_chunks)
+            self._arrivals = np.maximum.accumulate(self._arrivals)
+        self._dropped = random_state.uniform(size=n_chunks) < drop_rate
+        if np.any(self._dropped):
+            logger.info('Dropping %d of %d chunks.' %
+                        (np.sum(self._dropped), n_chunks))
+
+        self._start_time = None
+        self._next_chunk = 0
+        self._window = np.empty((0, len(self._ch_names)))
+        self._window_ts = np.empty(0)
+
+    @property
+    def finished(self):
+        """Whether all chunks have been returned."""
+        return self._next_chunk >= len(self._stops)
+
+    def get_sample_rate(self):
+        """The sampling frequency of the recording in Hz."""
+        return self.sfreq
+
+    def get_trigger_channel(self):
+        """The index of the trigger channel."""
+        return 0
+
+    def get_channel_names(self):
+        """The names of the channels, starting with the trigger channel."""
+        return list(self._ch_names)
+
+    def get_num_channels(self):
+        """The number of channels, including the trigger channel."""
+        return len(self._ch_names)
+
+    def acquire(self):
+        """Get the chunks that arrived since the previous call.
+
+        Blocks until at least one chunk has arrived. When all chunks have
+        been returned, empty arrays are returned.
+
+        Returns
+        -------
+        data : ndarray, shape (n_samples, n_channels)
+            The samples of the chunks.
+        timestamps : ndarray, shape (n_samples,)
+            The timestamp of each sample.
+        """
+        if self._start_time is None:
+            self._start_time = local_clock()
+        first = self._next_chunk
+        if self.finished:
+            return self._data[:0], np.empty(0)
+
+        if self.speed is None:
+            last = first + 1
+        else:
+            wait = (self._start_time + self._arrivals[first]) - local_clock()
+            if wait > 0:
+                time.sleep(wait)
+            elapsed = local_clock() - self._start_time
+            last = np.searchsorted(self._arrivals, elapsed, side='right')
+            last = max(last, first + 1)
+        self._next_chunk = last
+
+        samples = np.arange(self._stops[first - 1] if first > 0 else 0,
+                            self._stops[last - 1])
+        samples = samples[~self._dropped[samples // self.chunk_size]]
+        rate = self.sfreq * (1 if self.speed is None else self.speed)
+        timestamps = self._start_time + samples / rate
+        data = self._data[samples]
+
+        # Keep the recent samples, for get_window
+        self._window = np.vstack((self._window, data))[-self._n_window:]
+        self._window_ts = np.concatenate((self._window_ts,
+                                          timestamps))[-self._n_window:]
+        return data, timestamps
+
+    def get_window(self):
+        """Get the most recent samples, spanning ``window_size`` seconds.
+
+        Returns
+        -------
+        data : ndarray, shape (n_samples, n_channels)
+            The samples.
+        timestamps : ndarray, shape (n_samples,)
+            The timestamp of each sample.
+        """
+        return self._window, self._window_ts
+
+
+@verbose
+def stream_lsl(receiver, name='ReplayStream', verbose=None):
+    """Publish a replay on an LSL outlet, until all chunks were sent.
+
+    Parameters
+    ----------
+    receiver : instance of ReplayReceiver
+        The replay to publish.
+    name : str
+        The name of the LSL stream. Defaults to ``'ReplayStream'``.
+    verbose : int | bool | None
+        Controls the verbosity.
+    """
+    import pylsl
+
+    info = pylsl.StreamInfo(name, 'EEG', receiver.get_num_channels(),
+                            receiver.get_sample_rate(), 'float32', name)
+    channels = info.desc().append_child('channels')
+    for ch_name in receiver.get_channel_names():
+        channels.append_child('channel').append_child_value('label', ch_name)
+    outlet = pylsl.StreamOutlet(info, receiver.chunk_size)
+
+    logger.info('Streaming %d samples on LSL stream %s' %
+                (receiver.n_samples, name))
+    while not receiver.finished:
+        data, timestamps = receiver.acquire()
+        if len(timestamps) > 0:
+            outlet.push_chunk(data.tolist(), timestamps[-1])
+
+
+@verbose
+def compare_with_backfit(receiver, templates, ch_names=None, min_peak_dist=2,
+                         lookahead=None, verbose=None):
+    """Label a whole replay online and compare with offline labelling.
+
+    The replay is fed to an :class:`streaming.OnlineSegmenter` whose window
+    spans the whole recording. Its labels are compared with those of the
+    same rule applied offline (GFP peaks found with ``find_peaks`` and each
+    peak labelling the samples up to the midpoint to the next one), which
+    should agree exactly, and with sample by sample back-fitting with
+    :func:`microstates.backfit`. The replay should not drop chunks, so that
+    samples stay aligned.
+
+    Parameters
+    ----------
+    receiver : instance of ReplayReceiver
+        The replay, which has not been started yet.
+    templates : ndarray, shape (n_states, n_channels)
+        The topographic maps of the microstates.
+    ch_names : list of str | None
+        The channel of each column of the templates. Defaults to ``None``,
+        in which case all channels except the trigger are used, in order.
+    min_peak_dist : int
+        Minimum distance (in samples) between peaks in the GFP. Defaults to 2.
+    lookahead : int | None
+        The number of samples to wait after a peak before confirming it. See
+        :class:`streaming.GFPPeakDetector`. Defaults to ``None``.
+    verbose : int | bool | None
+        Controls the verbosity.
+
+    Returns
+    -------
+    peak_agreement : float
+        The fraction of samples with the same label online and with the
+        offline peak rule, among the samples labelled by both.
+    backfit_agreement : float
+        The fraction of samples labelled online that have the same label
+        when back-fitted.
+    """
+    all_names = receiver.get_channel_names()
+    if ch_names is None:
+        picks = np.arange(1, len(all_names))
+    else:
+        picks = np.array([all_names.index(ch) for ch in ch_names])
+    templates = normalize_templates(templates)
+
+    segmenter = OnlineSegmenter(templates, receiver.n_samples, 0,
+                                min_peak_dist, lookahead)
+    samples = []
+    while not receiver.finished:
+        data, timestamps = receiver.acquire()
+        segmenter.update(data.T[picks], timestamps)
+        samples.append(data.T[picks])
+    data = np.hstack(samples)
+    online = segmenter.labels
+
+    # The same rule, applied to the whole recording
+    peaks, _ = find_peaks(_gfp(data), distance=min_peak_dist)
+    peak_labels, _ = match_templates(data[:, peaks], templates)
+    offline = np.full(data.shape[1], -1)
+    if len(peaks) > 1:
+        bounds = np.concatenate(([peaks[0]], (peaks[:-1] + peaks[1:]) // 2))
+        offline[bounds[0]:bounds[-1]] = np.repeat(peak_labels[:-1],
+                                                  np.diff(bounds))
+
+    both = (online >= 0) & (offline >= 0)
+    peak_agreement = np.mean(online[both] == offline[both])
+    backfitted, _ = backfit(data, templates, verbose=False)
+    labelled = online >= 0
+    backfit_agreement = np.mean(online[labelled] == backfitted[labelled])
+    logger.info('Online labels agree with the offline peak rule for %.2f%% '
+                'and with back-fitting for %.2f%% of the samples.' %
+                (100 * peak_agreement, 100 * backfit_agreement))
+    return peak_agreement, backfit_agreement
@@ -0,0 +1,120 @@
+"""
+Fixed-cadence scheduling of the online feedback.
+
+The processing loop runs once per hop, on a fixed grid of deadlines, instead
+of as fast as the data arrives. The time spent processing each hop is
+checked against the hop length, which is the budget of an update.
+"""
+import time
+import numpy as np
+from mne.utils import logger
+
+
+class HopScheduler(object):
+    """Run a loop at a fixed cadence and report when hops overrun.
+
+    Call :meth:`wait` at the start of each iteration of the loop. The first
+    call returns immediately and starts the grid of deadlines. Each later
+    call sleeps until the next deadline. When processing took longer than a
+    hop, the missed deadlines are skipped rather than caught up with, so the
+    cadence is kept.
+
+    Parameters
+    ----------
+    hop : float | None
+        The time between updates in seconds. When ``None`` or 0, the loop is
+        not paced and :meth:`wait` returns immediately.
+    clock : callable
+        The monotonic clock, returning seconds. Defaults to
+        ``time.perf_counter``.
+    report_interval : float
+        The minimum time in seconds between two warnings about overruns.
+        Defaults to 1.
+
+    Attributes
+    ----------
+    n_hops : int
+        The number of hops started.
+    n_overruns : int
+        The number of hops whose processing took longer than a hop.
+    n_skipped : int
+        The number of deadlines skipped because of overruns.
+    max_busy : float
+        The longest processing time of a hop in seconds.
+    """
+    def __init__(self, hop, clock=time.perf_counter, report_interval=1.):
+        self.hop = hop
+        self.clock = clock
+        self.report_interval = report_interval
+        self.n_hops = 0
+        self.n_overruns = 0
+        self.n_skipped = 0
+        self.max_busy = 0.
+        self._deadline = None
+        self._hop_start = None
+        self._last_report = -np.inf
+        self._unreported = 0
+
+    def wait(self, sleep=time.sleep):
+        """Wait for the start of the next hop.
+
+        Parameters
+        ----------
+        sleep : callable
+            Called with the time to wait in seconds. If it returns ``True``,
+            the wait was interrupted, for example because the session was
+            stopped. Defaults to ``time.sleep``.
+            ``SessionControl.wait_for_stop`` can be used to wake up when the
+            session stops.
+
+        Returns
+        -------
+        interrupted : bool
+            Whether the wait was interrupted.
+        """
+        now = self.clock()
+        if self._hop_start is not None:
+            self._check_budget(now - self._hop_start)
+        if not self.hop:
+            self._start_hop(now)
+            return False
+        if self._deadline is None:
+            self._deadline = now
+        else:
+            self._deadline += self.hop
+            if now > self._deadline:
+                # Skip the missed deadlines, keeping the grid
+                missed = int((now - self._deadline) // self.hop) + 1
+                self.n_skipped += missed
+                self._deadline += missed * self.hop
+            if sleep(self._deadline - now):
+                return True
+        self._start_hop(self.clock())
+        return False
+
+    def _start_hop(self, now):
+        """Record the start of a hop."""
+        self._hop_start = now
+        self.n_hops += 1
+
+    def _check_budget(self, busy):
+        """Check the processing time of the last hop against the budget."""
+        self.max_busy = max(self.max_busy, busy)
+        if not self.hop or busy <= self.hop:
+            return
+        self.n_overruns += 1
+        self._unreported += 1
+        if self._hop_start - self._last_report >= self.report_interval:
+            logger.warning('Processing took %.1f ms, over the budget of '
+                           '%.1f ms per hop (%d overrun(s) since the last '
+                           'report).' % (busy * 1000, self.hop * 1000,
+                                         self._unreported))
+            self._last_report = self._hop_start
+            self._unreported = 0
+
+    def log_summary(self):
+        """Log the number of hops and overruns."""
+        logger.info('%d hops, %d over budget, %d deadlines skipped, longest '
+                    'processing %.1f ms.' % (self.n_hops, self.n_overruns,
+                                             self.n_skipped,
+                                             self.max_busy * 1000))
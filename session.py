@@ -0,0 +1,142 @@
+"""
+Start/stop control of a protocol session, shared between processes.
+
+The GUI and the protocols share an integer state: 0 to stop, 1 to start
+(running) and 2 to wait. Instead of spinning on that value, the protocols
+block on a condition until it changes, a deadline passes or the session is
+aborted.
+"""
+import time
+import multiprocessing as mp
+
+STOP, START, WAIT = 0, 1, 2
+
+
+class SessionControl(object):
+    """Blocking start, stop and abort transitions of a session.
+
+    Parameters
+    ----------
+    state : multiprocessing.Value | instance of SessionControl | None
+        The state shared with the GUI (0: stop, 1: start, 2: wait). When a
+        ``SessionControl`` is given, it is returned as is by
+        :func:`session_control`. Defaults to ``None``, in which case a new
+        state is created, set to wait.
+    check_interval : float | None
+        Processes that write ``state.value`` directly, like the GUI, cannot
+        wake up the waiting protocols. Waits are therefore cut in slices of
+        this many seconds, after each of which the state is checked again.
+        Set to ``None`` when all writers use :meth:`set_state`, to block
+        until notified. Defaults to 0.1.
+    """
+    def __init__(self, state=None, check_interval=0.1):
+        if state is None:
+            state = mp.Value('i', WAIT)
+        self.state = state
+        self.check_interval = check_interval
+        self._changed = mp.Condition()
+        self._aborted = mp.Event()
+
+    @property
+    def value(self):
+        """The current state (0: stop, 1: start, 2: wait)."""
+        return self.state.value
+
+    @property
+    def running(self):
+        """Whether the session has started and was not stopped."""
+        return self.state.value == START
+
+    @property
+    def aborted(self):
+        """Whether the session was aborted."""
+        return self._aborted.is_set()
+
+    def set_state(self, value):
+        """Change the state and wake up all waiting processes.
+
+        Parameters
+        ----------
+        value : int
+            The new state (0: stop, 1: start, 2: wait).
+        """
+        with self._changed:
+            with self.state.get_lock():
+                self.state.value = value
+            self._changed.notify_all()
+
+    def start(self):
+        """Start the session."""
+        self.set_state(START)
+
+    def stop(self):
+        """Stop the session, letting the protocol finish normally."""
+        self.set_state(STOP)
+
+    def abort(self):
+        """Stop the session, asking the protocol to quit immediately."""
+        self._aborted.set()
+        self.set_state(STOP)
+
+    def wait_for_start(self, timeout=None):
+        """Block while the session is waiting to start.
+
+        Parameters
+        ----------
+        timeout : float | None
+            Maximum time to wait in seconds. ``None`` waits forever.
+
+        Returns
+        -------
+        started : bool
+            Whether the session is running.
+        """
+        self._wait(lambda: self.state.value != WAIT, timeout)
+        return self.running
+
+    def wait_for_stop(self, timeout=None):
+        """Block while the session is running.
+
+        Parameters
+        ----------
+        timeout : float | None
+            Maximum time to wait in seconds. ``None`` waits forever.
+
+        Returns
+        -------
+        stopped : bool
+            Whether the session was stopped, rather than the timeout passing.
+        """
+        return self._wait(lambda: self.state.value != START, timeout)
+
+    def _wait(self, predicate, timeout):
+        """Wait for a predicate on the state to become true."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            while not predicate():
+                wait = self.check_interval
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._changed.wait(wait)
+            return True
+
+
+def session_control(state):
+    """Get the session control for the state passed to a protocol.
+
+    Parameters
+    ----------
+    state : multiprocessing.Value | instance of SessionControl
+        The state given to the ``run`` function of a protocol.
+
+    Returns
+    -------
+    session : instance of SessionControl
+        The session control.
+    """
+    if isinstance(state, SessionControl):
+        return state
+    return SessionControl(state)
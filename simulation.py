@@ -0,0 +1,92 @@
+"""
+Synthetic EEG with known microstates.
+
+The signal is a sequence of microstate segments of random duration. Within a
+segment, the topography is that of the microstate, scaled by an oscillating
+global field power (GFP), so that each segment contains GFP peaks. As in real
+EEG, the polarity of the topography can flip at each GFP minimum.
+"""
+import numpy as np
+
+
+def simulate_microstates(n_channels=19, n_samples=10000, n_states=4,
+                         sfreq=250., mean_duration=0.08, gfp_freq=10.,
+                         polarity_flips=True, noise=0.1, maps=None,
+                         random_state=None):
+    """Generate EEG made of microstates, together with the ground truth.
+
+    Parameters
+    ----------
+    n_channels : int
+        The number of channels. Defaults to 19.
+    n_samples : int
+        The number of samples. Defaults to 10000.
+    n_states : int
+        The number of microstates. Defaults to 4.
+    sfreq : float
+        The sampling frequency in Hz. Defaults to 250.
+    mean_duration : float
+        The mean duration of a microstate segment in seconds. Durations are
+        drawn from a gamma distribution. Defaults to 0.08.
+    gfp_freq : float
+        The frequency in Hz of the oscillation of the topography. The GFP
+        peaks twice per period. Defaults to 10.
+    polarity_flips : bool
+        Whether the polarity of the topography flips at each GFP minimum.
+        Otherwise the polarity is constant. Defaults to ``True``.
+    noise : float
+        The standard deviation of the white noise added to each channel,
+        relative to the peak GFP of the microstates. Defaults to 0.1.
+    maps : ndarray, shape (n_states, n_channels) | None
+        The topographic maps of the microstates. Defaults to ``None``, in
+        which case random maps are drawn.
+    random_state : int | numpy.random.RandomState | None
+        The seed or ``RandomState`` for the random number generator.
+        Defaults to ``None``.
+
+    Returns
+    -------
+    data : ndarray, shape (n_channels, n_samples)
+        The simulated EEG.
+    maps : ndarray, shape (n_states, n_channels)
+        The topographic maps of the microstates, centered and scaled to unit
+        GFP.
+    labels : ndarray of int, shape (n_samples,)
+        For each sample, the index of its microstate.
+    """
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+
+    if maps is None:
+        maps = random_state.randn(n_states, n_channels)
+    maps = np.array(maps, dtype=float)
+    maps -= np.mean(maps, axis=1, keepdims=True)
+    maps /= np.std(maps, axis=1, keepdims=True)
+
+    # Segment durations from a gamma distribution (shape 4), enough of them
+    # to cover all samples. Consecutive segments have different states.
+    mean_len = max(mean_duration * sfreq, 1.)
+    n_segments = int(2 * n_samples / mean_len) + 10
+    lengths = np.maximum(np.round(random_state.gamma(
+        4., mean_len / 4., size=n_segments)), 1).astype(int)
+    while np.sum(lengths) < n_samples:
+        lengths = np.concatenate((lengths, lengths))
+    states = np.empty(n_segments, dtype=int)
+    states[0] = random_state.randint(n_states)
+    if n_states > 1:
+        steps = random_state.randint(1, n_states, size=n_segments - 1)
+        states[1:] = (states[0] + np.cumsum(steps)) % n_states
+    else:
+        states[1:] = 0
+    labels = np.repeat(np.resize(states, len(lengths)), lengths)[:n_samples]
+
+    # The topography oscillates, restarting at each segment
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    phase = np.arange(n_samples) - np.repeat(starts, lengths)[:n_samples]
+    amplitude = np.sin(np.pi * (phase + 0.5) * 2 * gfp_freq / sfreq)
+    if not polarity_flips:
+        amplitude = np.abs(amplitude)
+
+    data = maps[labels].T * amplitude
+    data += noise * random_state.randn(n_channels, n_samples)
+    return data, maps, labels
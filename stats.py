@@ -0,0 +1,228 @@
+"""
+Temporal statistics of microstate segmentations.
+
+The segmentation is run-length encoded: each run of consecutive samples with
+the same label is one occurrence of a microstate. From the runs, the
+standard parameters are computed per microstate: mean duration, occurrence
+per second, time coverage and global explained variance (GEV), as well as
+the probabilities of the transitions between microstates. Samples labelled
+-1 (not labelled) are left out, and no transition is counted across them.
+"""
+from collections import deque
+import numpy as np
+
+from microstates import normalize_templates, run_lengths, _gfp
+
+
+def segmentation_stats(segmentation, sfreq, n_states=None, data=None,
+                       maps=None):
+    """Compute the temporal parameters of each microstate.
+
+    Parameters
+    ----------
+    segmentation : array-like of int, shape (n_samples,)
+        For each sample, the index of its microstate, as returned by
+        :func:`microstates.segment`. Samples labelled -1 are left out.
+    sfreq : float
+        The sampling frequency in Hz.
+    n_states : int | None
+        The number of microstates. Defaults to ``None``, in which case the
+        highest label plus one is used.
+    data : ndarray, shape (n_channels, n_samples) | None
+        The segmented data, to compute the GEV of each microstate.
+    maps : ndarray, shape (n_states, n_channels) | None
+        The topographic maps of the microstates, to compute the GEV of each
+        microstate.
+
+    Returns
+    -------
+    stats : dict
+        The parameters of each microstate, as arrays of shape (n_states,):
+        ``'mean_duration'`` in seconds, ``'occurrence'`` per second,
+        ``'coverage'`` as a fraction of the labelled time and, when ``data``
+        and ``maps`` are given, ``'gev'``. ``'transitions'`` holds the
+        transition probability matrix, shape (n_states, n_states), whose row
+        ``i`` gives the probability of each microstate following
+        microstate ``i``.
+    """
+    segmentation = np.asarray(segmentation)
+    if n_states is None:
+        n_states = int(segmentation.max()) + 1
+    labels, _, lengths = run_lengths(segmentation)
+    valid = labels >= 0
+    n_samples = np.bincount(labels[valid], weights=lengths[valid],
+                            minlength=n_states)
+    n_runs = np.bincount(labels[valid], minlength=n_states)
+
+    # Transitions between consecutive runs, both labelled
+    pairs = valid[:-1] & valid[1:]
+    transitions = np.bincount(labels[:-1][pairs] * n_states +
+                              labels[1:][pairs], minlength=n_states ** 2)
+    transitions = transitions.reshape(n_states, n_states)
+
+    stats = _stats_from_counts(n_samples, n_runs, transitions, sfreq)
+    if data is not None and maps is not None:
+        stats['gev'] = _gev_per_state(data, maps, segmentation, n_states)
+    return stats
+
+
+def _stats_from_counts(n_samples, n_runs, transitions, sfreq):
+    """Compute the temporal parameters from the counts of samples and runs.
+
+    See :func:`segmentation_stats` for the returned parameters.
+    """
+    total = np.sum(n_samples)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_duration = n_samples / n_runs / sfreq
+        occurrence = n_runs / (total / sfreq)
+        coverage = n_samples / total
+        probabilities = transitions / np.sum(transitions, axis=1,
+                                             keepdims=True)
+    return dict(mean_duration=mean_duration, occurrence=occurrence,
+                coverage=coverage, transitions=np.nan_to_num(probabilities))
+
+
+def _gev_per_state(data, maps, segmentation, n_states):
+    """The contribution of each microstate to the GEV of a segmentation."""
+    labelled = segmentation >= 0
+    data = data[:, labelled]
+    segmentation = segmentation[labelled]
+    templates = normalize_templates(maps)
+    gfp = _gfp(data)
+    centered = data - np.mean(data, axis=0)
+    norms = np.linalg.norm(centered, axis=0)
+    corr = np.abs(np.einsum('ij,ji->i', templates[segmentation], centered))
+    corr /= np.where(norms == 0, np.inf, norms)
+    explained = np.bincount(segmentation, weights=(gfp * corr) ** 2,
+                            minlength=n_states)
+    return explained / np.sum(gfp ** 2)
+
+
+class OnlineStats(object):
+    """Temporal parameters of a segmentation that grows in chunks.
+
+    The labels are passed in chronological order, in chunks of any size.
+    A run that continues from one chunk to the next is counted once. The
+    cost of an update only depends on the number of new runs. The
+    parameters are computed either over all labels so far, or over a
+    trailing window, in which case runs are discounted as they leave it.
+
+    Parameters
+    ----------
+    n_states : int
+        The number of microstates.
+    sfreq : float
+        The sampling frequency in Hz.
+    window : int | None
+        The number of most recent samples to compute the parameters over.
+        A run that is partly in the window counts as an occurrence.
+        Defaults to ``None``, in which case all labels are used.
+
+    Attributes
+    ----------
+    mean_duration : ndarray, shape (n_states,)
+        The mean duration of each microstate in seconds.
+    occurrence : ndarray, shape (n_states,)
+        The number of occurrences of each microstate per second.
+    coverage : ndarray, shape (n_states,)
+        The fraction of the labelled time covered by each microstate.
+    transitions : ndarray, shape (n_states, n_states)
+        The transition probability matrix.
+    """
+    def __init__(self, n_states, sfreq, window=None):
+        self.n_states = n_states
+        self.sfreq = sfreq
+        self.window = window
+        self.n_samples = np.zeros(n_states)
+        self.n_runs = np.zeros(n_states, dtype=int)
+        self.n_transitions = np.zeros((n_states, n_states), dtype=int)
+
+        # The runs that are (partly) in the window, as [label, length], and
+        # their total length, including the unlabelled ones.
+        self._runs = deque()
+        self._length = 0
+
+    def update(self, labels):
+        """Add the next chunk of labels.
+
+        Parameters
+        ----------
+        labels : array-like of int, shape (n_new,)
+            The labels of the new samples, -1 for unlabelled samples.
+        """
+        run_labels, _, lengths = run_lengths(labels)
+        if len(run_labels) == 0:
+            return
+        if self._runs and self._runs[-1][0] == run_labels[0]:
+            # The last run continues
+            self._extend_last(lengths[0])
+            run_labels, lengths = run_labels[1:], lengths[1:]
+        for label, length in zip(run_labels, lengths):
+            self._add_run(label, length)
+        self._trim()
+
+    def _extend_last(self, length):
+        """Add samples to the last run."""
+        label = self._runs[-1][0]
+        self._runs[-1][1] += length
+        self._length += length
+        if label >= 0:
+            self.n_samples[label] += length
+
+    def _add_run(self, label, length):
+        """Add a new run after the last one."""
+        if label >= 0:
+            self.n_runs[label] += 1
+            self.n_samples[label] += length
+            if self._runs and self._runs[-1][0] >= 0:
+                self.n_transitions[self._runs[-1][0], label] += 1
+        self._runs.append([label, length])
+        self._length += length
+
+    def _trim(self):
+        """Discount the samples and runs that left the window."""
+        if self.window is None:
+            # Only the last run is needed, to continue it
+            while len(self._runs) > 1:
+                self._length -= self._runs.popleft()[1]
+            return
+        excess = self._length - self.window
+        while excess > 0:
+            run = self._runs[0]
+            label, cut = run[0], min(excess, run[1])
+            run[1] -= cut
+            self._length -= cut
+            excess -= cut
+            if label >= 0:
+                self.n_samples[label] -= cut
+            if run[1] == 0:
+                self._runs.popleft()
+                if label >= 0:
+                    self.n_runs[label] -= 1
+                    if self._runs and self._runs[0][0] >= 0:
+                        self.n_transitions[label, self._runs[0][0]] -= 1
+
+    def _stats(self):
+        """Compute the parameters from the current counts."""
+        return _stats_from_counts(self.n_samples, self.n_runs,
+                                  self.n_transitions, self.sfreq)
+
+    @property
+    def mean_duration(self):
+        """The mean duration of each microstate in seconds."""
+        return self._stats()['mean_duration']
+
+    @property
+    def occurrence(self):
+        """The number of occurrences of each microstate per second."""
+        return self._stats()['occurrence']
+
+    @property
+    def coverage(self):
+        """The fraction of the labelled time covered by each microstate."""
+        return self._stats()['coverage']
+
+    @property
+    def transitions(self):
+        """The transition probability matrix."""
+        return self._stats()['transitions']
@@ -0,0 +1,845 @@
+"""
+Building blocks to process EEG one block of samples at a time, for
+recordings that do not fit in memory or that arrive in real time.
+
+The blocks are passed as arrays of shape (n_channels, n_samples). All classes
+carry the state they need between consecutive blocks, so that the result
+does not depend on how the data is cut into blocks.
+"""
+import numpy as np
+from scipy.signal import butter, sosfilt, sosfilt_zi, find_peaks
+from mne.utils import logger, verbose
+
+from microstates import normalize_templates, match_templates, _gfp
+
+
+class BandpassFilter(object):
+    """Causal IIR band-pass filter that carries its state across blocks.
+
+    Parameters
+    ----------
+    l_freq : float | None
+        The low cut-off frequency in Hz. When ``None``, a low-pass filter is
+        used.
+    h_freq : float | None
+        The high cut-off frequency in Hz. When ``None``, a high-pass filter
+        is used.
+    sfreq : float
+        The sampling frequency of the data in Hz.
+    order : int
+        The order of the Butterworth filter. Defaults to 4.
+    """
+    def __init__(self, l_freq, h_freq, sfreq, order=4):
+        if l_freq is None and h_freq is None:
+            raise ValueError('At least one of l_freq and h_freq must be set.')
+        elif l_freq is None:
+            btype, freqs = 'lowpass', h_freq
+        elif h_freq is None:
+            btype, freqs = 'highpass', l_freq
+        else:
+            btype, freqs = 'bandpass', [l_freq, h_freq]
+        self.l_freq = l_freq
+        self.h_freq = h_freq
+        self.sfreq = sfreq
+        self.sos = butter(order, freqs, btype=btype, fs=sfreq, output='sos')
+        self.zi = None
+
+    def process(self, block):
+        """Filter the next block of samples.
+
+        Parameters
+        ----------
+        block : ndarray, shape (n_channels, n_samples)
+            The next block of samples.
+
+        Returns
+        -------
+        filtered : ndarray, shape (n_channels, n_samples)
+            The filtered block.
+        """
+        if self.zi is None:
+            # Start in the steady state for the first sample, to avoid a
+            # large transient at the start of the recording.
+            zi = sosfilt_zi(self.sos)[:, np.newaxis, :]
+            self.zi = zi * block[np.newaxis, :, :1]
+        filtered, self.zi = sosfilt(self.sos, block, axis=1, zi=self.zi)
+        return filtered
+
+
+class OnlinePreprocessor(object):
+    """Causal preprocessing of a live stream, matching the training data.
+
+    Only the samples that are newer than those of the previous call are
+    processed, so the cost of a call only depends on the number of new
+    samples. They are picked and reordered to match the templates,
+    re-referenced to the average of the picked channels, filtered with
+    a :class:`BandpassFilter` that carries its state across calls and, when
+    the training data was normalized, z-scored with the mean and standard
+    deviation of each channel in the training data.
+
+    Parameters
+    ----------
+    picks : array-like of int
+        The index in the stream of each channel to keep, in the order of the
+        templates. See :meth:`templates.Templates.get_picks`.
+    l_freq : float | None
+        The low cut-off frequency of the filter, as applied to the training
+        data.
+    h_freq : float | None
+        The high cut-off frequency of the filter, as applied to the training
+        data.
+    sfreq : float
+        The sampling frequency of the stream in Hz.
+    average_reference : bool
+        Whether to re-reference the data to the average. Defaults to
+        ``True``.
+    order : int
+        The order of the Butterworth filter. Defaults to 4.
+    scaling : tuple of ndarray | None
+        The mean and standard deviation of each picked channel in the
+        training data, to normalize the filtered samples with. Defaults to
+        ``None``, in which case the samples are not normalized.
+
+    Attributes
+    ----------
+    last_ts : float
+        The timestamp of the most recent sample.
+    """
+    def __init__(self, picks, l_freq, h_freq, sfreq, average_reference=True,
+                 order=4, scaling=None):
+        self.picks = np.asarray(picks)
+        self.average_reference = average_reference
+        self.scaling = scaling
+        self.last_ts = -np.inf
+        if l_freq is None and h_freq is None:
+            self.bandpass = None
+        else:
+            self.bandpass = BandpassFilter(l_freq, h_freq, sfreq, order)
+
+    @classmethod
+    def from_templates(cls, templates, ch_names, sfreq, trigger=None,
+                       **kwargs):
+        """Preprocess a stream like the data the templates were fitted on.
+
+        Parameters
+        ----------
+        templates : instance of Templates
+            The templates, whose channel names, filter settings and channel
+            scaling are used.
+        ch_names : list of str
+            The names of the channels of the stream.
+        sfreq : float
+            The sampling frequency of the stream in Hz.
+        trigger : int | None
+            The index of the trigger channel of the stream. For templates
+            without channel names, all other channels are used, in order.
+            Defaults to ``None``.
+        **kwargs
+            The other parameters of :class:`OnlinePreprocessor`.
+
+        Returns
+        -------
+        preprocessor : instance of OnlinePreprocessor
+            The preprocessor.
+        """
+        if templates.ch_names is None:
+            logger.warning('The templates do not contain channel names. '
+                           'Assuming the channels of the stream are in the '
+                           'order of the templates.')
+            picks = [i for i in range(len(ch_names)) if i != trigger]
+        else:
+            picks = templates.get_picks(ch_names)
+        if templates.sfreq is not None and templates.sfreq != sfreq:
+            logger.warning('The templates were fitted on data sampled at '
+                           '%g Hz, but the stream is sampled at %g Hz.' %
+                           (templates.sfreq, sfreq))
+        if templates.l_freq is None and templates.h_freq is None:
+            logger.info('No filter settings in the templates, the stream '
+                        'is not filtered.')
+        else:
+            logger.info('Filtering the stream from %s to %s Hz.' %
+                        (templates.l_freq, templates.h_freq))
+        if templates.scaling is not None:
+            logger.info('Normalizing the stream like the training data.')
+            kwargs.setdefault('scaling', templates.scaling)
+        return cls(picks, templates.l_freq, templates.h_freq, sfreq, **kwargs)
+
+    def process(self, samples, timestamps):
+        """Preprocess the samples that are newer than the previous call.
+
+        Parameters
+        ----------
+        samples : ndarray, shape (n_channels, n_samples)
+            A chunk of samples from the stream, with all its channels. It
+            may overlap with the samples of the previous call.
+        timestamps : array-like, shape (n_samples,)
+            The timestamp of each sample.
+
+        Returns
+        -------
+        block : ndarray, shape (n_picks, n_new)
+            The preprocessed new samples.
+        timestamps : ndarray, shape (n_new,)
+            The timestamp of each new sample.
+        """
+        timestamps = np.asarray(timestamps)
+        new = timestamps > self.last_ts
+        block = samples[self.picks][:, new].astype(float)
+        timestamps = timestamps[new]
+        if len(timestamps) == 0:
+            return block, timestamps
+        self.last_ts = timestamps[-1]
+
+        if self.average_reference:
+            block -= np.mean(block, axis=0, keepdims=True)
+        if self.bandpass is not None:
+            block = self.bandpass.process(block)
+        if self.scaling is not None:
+            mean, std = self.scaling
+            block = (block - mean[:, np.newaxis]) / std[:, np.newaxis]
+        return block, timestamps
+
+
+class GFPPeakDetector(object):
+    """Causal detector of the peaks in the global field power (GFP).
+
+    The GFP (spatial standard deviation) is computed for the samples as they
+    arrive. Local maxima are kept as candidates until ``lookahead`` samples
+    past them have been seen. Then they are confirmed or rejected using the
+    same rule as ``scipy.signal.find_peaks(gfp, distance=min_peak_dist)``,
+    which :func:`microstates.segment` uses: of two peaks closer than
+    ``min_peak_dist``, the highest is kept. Confirmed peaks are therefore
+    reported with a latency of ``lookahead`` samples. This gives the same
+    peaks as running ``find_peaks`` on the whole recording, except for
+    chains of ever higher peaks closer than ``min_peak_dist`` to each other
+    that span more than ``lookahead`` samples. A lookahead of a few times
+    ``min_peak_dist`` is enough in practice.
+
+    Parameters
+    ----------
+    min_peak_dist : int
+        Minimum distance (in samples) between peaks in the GFP. Defaults to 2.
+    lookahead : int | None
+        The number of samples to wait after a peak before confirming it.
+        Defaults to ``None``, in which case ``3 * min_peak_dist`` is used.
+    monitor : instance of LatencyMonitor | None
+        If given, the ``'gfp'`` and ``'peaks'`` stages of each update are
+        timed with it. Defaults to ``None``.
+
+    Attributes
+    ----------
+    n_samples : int
+        The total number of samples processed so far.
+    """
+    def __init__(self, min_peak_dist=2, lookahead=None, monitor=None):
+        if lookahead is None:
+            lookahead = 3 * min_peak_dist
+        self.min_peak_dist = min_peak_dist
+        self.lookahead = lookahead
+        self.monitor = monitor
+        self.n_samples = 0
+
+        # The samples from the last sample that differs from the final one.
+        # Peaks in there are not known yet, as they need a falling edge.
+        self._tail_start = 0
+        self._tail_gfp = np.empty(0)
+        self._tail_data = None
+
+        # Candidate peaks that are not confirmed yet
+        self._cand_index = np.empty(0, dtype=int)
+        self._cand_gfp = np.empty(0)
+        self._cand_data = None
+
+        # Confirmed peaks that can still reject later candidates
+        self._kept_index = np.empty(0, dtype=int)
+        self._kept_gfp = np.empty(0)
+
+    def update(self, block):
+        """Process the next block of samples.
+
+        Parameters
+        ----------
+        block : ndarray, shape (n_channels, n_samples)
+            The next block of samples.
+
+        Returns
+        -------
+        peaks : ndarray of int, shape (n_peaks,)
+            The index (counted from the first sample ever processed) of each
+            peak that was confirmed.
+        topographies : ndarray, shape (n_channels, n_peaks)
+            The data at the confirmed peaks.
+        """
+        if self._tail_data is None:
+            self._tail_data = np.empty((block.shape[0], 0))
+            self._cand_data = np.empty((block.shape[0], 0))
+
+        gfp = np.concatenate((self._tail_gfp, _gfp(block)))
+        if self.monitor is not None:
+            self.monitor.mark('gfp')
+        data = np.hstack((self._tail_data, block))
+        maxima, _ = find_peaks(gfp)
+        self._cand_index = np.concatenate((self._cand_index,
+                                           self._tail_start + maxima))
+        self._cand_gfp = np.concatenate((self._cand_gfp, gfp[maxima]))
+        self._cand_data = np.hstack((self._cand_data, data[:, maxima]))
+
+        # Keep the trailing plateau and the sample before it
+        changes = np.flatnonzero(gfp != gfp[-1])
+        first = changes[-1] if len(changes) > 0 else 0
+        self._tail_start += first
+        self._tail_gfp = gfp[first:]
+        self._tail_data = data[:, first:]
+
+        self.n_samples += block.shape[1]
+        peaks, topographies = self._confirm(self.n_samples - 1 -
+                                            self.lookahead)
+        if self.monitor is not None:
+            self.monitor.mark('peaks')
+        return peaks, topographies
+
+    def flush(self):
+        """Confirm all remaining candidates, at the end of the stream.
+
+        Returns
+        -------
+        peaks : ndarray of int, shape (n_peaks,)
+            The index of each peak that was confirmed.
+        topographies : ndarray, shape (n_channels, n_peaks)
+            The data at the confirmed peaks.
+        """
+        return self._confirm(np.inf)
+
+    def _confirm(self, until):
+        """Confirm or reject the candidates up to the given sample."""
+        n_kept = len(self._kept_index)
+        keep = _select_by_distance(
+            np.concatenate((self._kept_index, self._cand_index)),
+            np.concatenate((self._kept_gfp, self._cand_gfp)),
+            self.min_peak_dist, n_fixed=n_kept)[n_kept:]
+        decided = self._cand_index <= until
+        confirmed = decided & keep
+
+        peaks = self._cand_index[confirmed]
+        topographies = self._cand_data[:, confirmed]
+
+        # Only recent peaks can reject candidates still to come
+        self._kept_index = np.concatenate((self._kept_index, peaks))
+        self._kept_gfp = np.concatenate((self._kept_gfp,
+                                         self._cand_gfp[confirmed]))
+        recent = self._kept_index > until - self.min_peak_dist
+        self._kept_index = self._kept_index[recent]
+        self._kept_gfp = self._kept_gfp[recent]
+
+        self._cand_index = self._cand_index[~decided]
+        self._cand_gfp = self._cand_gfp[~decided]
+        self._cand_data = self._cand_data[:, ~decided]
+        return peaks, topographies
+
+
+def _select_by_distance(peaks, heights, distance, n_fixed=0):
+    """Select the highest of the peaks that are closer than some distance.
+
+    Follows the rule of ``scipy.signal.find_peaks``: going from the highest
+    peak down, each peak that is kept rejects its lower neighbours within
+    ``distance``. The first ``n_fixed`` peaks were confirmed before and
+    cannot be rejected anymore.
+    """
+    keep = np.ones(len(peaks), dtype=bool)
+    for j in np.argsort(heights)[::-1]:
+        if not keep[j]:
+            continue
+        k = j - 1
+        while k >= n_fixed and peaks[j] - peaks[k] < distance:
+            keep[k] = False
+            k -= 1
+        k = j + 1
+        while k < len(peaks) and peaks[k] - peaks[j] < distance:
+            keep[k] = False
+            k += 1
+    return keep
+
+
+class PeakCollector(object):
+    """Collect the topographies at the peaks of the global field power (GFP).
+
+    Peaks are detected across block boundaries with a
+    :class:`GFPPeakDetector`. When more than
+    ``max_n_peaks`` peaks are found, a uniformly random subset of them is
+    kept (reservoir sampling), so memory is bounded by the peak budget
+    rather than by the length of the recording.
+
+    Parameters
+    ----------
+    n_channels : int
+        The number of channels.
+    min_peak_dist : int
+        Minimum distance (in samples) between peaks in the GFP. Defaults to 2.
+    max_n_peaks : int | None
+        Maximum number of peaks to keep. ``None`` keeps all peaks. Defaults
+        to 10000.
+    random_state : int | numpy.random.RandomState | None
+        The seed or ``RandomState`` for the random number generator.
+
+    Attributes
+    ----------
+    n_seen : int
+        The total number of peaks found so far.
+    """
+    def __init__(self, n_channels, min_peak_dist=2, max_n_peaks=10000,
+                 random_state=None):
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        self.min_peak_dist = min_peak_dist
+        self.max_n_peaks = max_n_peaks
+        self.random_state = random_state
+        self.n_seen = 0
+        self._peaks = np.empty((n_channels, 0))
+        self._detector = GFPPeakDetector(min_peak_dist)
+
+    @property
+    def peaks(self):
+        """The topographies at the kept peaks.
+
+        ndarray, shape (n_channels, n_peaks)
+        """
+        return self._peaks
+
+    def update(self, block):
+        """Find the GFP peaks in the next block of samples.
+
+        Parameters
+        ----------
+        block : ndarray, shape (n_channels, n_samples)
+            The next block of samples.
+        """
+        _, topographies = self._detector.update(block)
+        self._add(topographies)
+
+    def flush(self):
+        """Collect the last peaks, at the end of the recording."""
+        _, topographies = self._detector.flush()
+        self._add(topographies)
+
+    def _add(self, new_peaks):
+        """Add peaks to the reservoir."""
+        n_new = new_peaks.shape[1]
+        capacity = self.max_n_peaks
+        if capacity is None:
+            self._peaks = np.hstack((self._peaks, new_peaks))
+            self.n_seen += n_new
+            return
+
+        # Fill up the reservoir first
+        n_free = min(capacity - self._peaks.shape[1], n_new)
+        if n_free > 0:
+            self._peaks = np.hstack((self._peaks, new_peaks[:, :n_free]))
+            self.n_seen += n_free
+            new_peaks = new_peaks[:, n_free:]
+            n_new -= n_free
+
+        # Then replace random peaks, such that each peak seen so far has the
+        # same chance of being kept.
+        if n_new > 0:
+            seen = self.n_seen + np.arange(1, n_new + 1)
+            slots = (self.random_state.rand(n_new) * seen).astype(int)
+            replace = np.flatnonzero(slots < capacity)
+
+            # When a slot is drawn more than once, the last peak wins
+            _, last = np.unique(slots[replace][::-1], return_index=True)
+            replace = replace[len(replace) - 1 - last]
+            self._peaks[:, slots[replace]] = new_peaks[:, replace]
+            self.n_seen += n_new
+
+
+@verbose
+def collect_peaks(raw, l_freq=1., h_freq=30., chunk_size=10000,
+                  min_peak_dist=2, max_n_peaks=10000, normalize=False,
+                  return_scaling=False, random_state=None, verbose=None):
+    """Collect the GFP-peak topographies of a recording, block by block.
+
+    The data is read in blocks, band-pass filtered with a causal filter whose
+    state is carried across blocks and re-referenced to the average. Only the
+    topographies at the GFP peaks are kept, so the memory used is bounded by
+    ``chunk_size`` and ``max_n_peaks`` rather than by the length of the
+    recording. The result can be clustered with
+    ``microstates.segment(peaks, use_peaks=False)``.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The recording. It does not need to be preloaded.
+    l_freq : float | None
+        The low cut-off frequency of the band-pass filter. Defaults to 1.
+    h_freq : float | None
+        The high cut-off frequency of the band-pass filter. Defaults to 30.
+    chunk_size : int
+        The number of samples to read at a time. Defaults to 10000.
+    min_peak_dist : int
+        Minimum distance (in samples) between peaks in the GFP. Defaults to 2.
+    max_n_peaks : int | None
+        Maximum number of GFP peaks to keep. Chosen randomly. Defaults to
+        10000.
+    normalize : bool
+        Whether to normalize (z-score) the data with the mean and standard
+        deviation of each channel over the whole filtered recording. These
+        are computed in a first pass over the recording, so that the peaks
+        are found in the normalized data, like
+        ``microstates.segment(normalize=True)`` does. Defaults to ``False``.
+    return_scaling : bool
+        Whether to also return the mean and standard deviation of each
+        channel used to normalize the topographies. Defaults to ``False``.
+    random_state : int | numpy.random.RandomState | None
+        The seed or ``RandomState`` for the random number generator.
+    verbose : int | bool | None
+        Controls the verbosity.
+
+    Returns
+    -------
+    peaks : ndarray, shape (n_channels, n_peaks)
+        The topographies at the kept GFP peaks.
+    scaling : tuple of ndarray | None
+        The mean and standard deviation of each channel, or ``None`` when
+        ``normalize=False``. Only returned when ``return_scaling=True``.
+    """
+    n_channels = len(raw.ch_names)
+    scaling = None
+    if normalize:
+        data_sum = np.zeros(n_channels)
+        data_sum_sq = np.zeros(n_channels)
+        for block in _preprocessed_blocks(raw, l_freq, h_freq, chunk_size):
+            data_sum += np.sum(block, axis=1)
+            data_sum_sq += np.sum(block ** 2, axis=1)
+        mean = data_sum / raw.n_times
+        scaling = (mean, np.sqrt(data_sum_sq / raw.n_times - mean ** 2))
+
+    collector = PeakCollector(n_channels, min_peak_dist, max_n_peaks,
+                              random_state)
+    for block in _preprocessed_blocks(raw, l_freq, h_freq, chunk_size,
+                                      scaling):
+        collector.update(block)
+    collector.flush()
+    logger.info('Kept %d out of %d GFP peaks' %
+                (collector.peaks.shape[1], collector.n_seen))
+
+    if return_scaling:
+        return collector.peaks, scaling
+    return collector.peaks
+
+
+@verbose
+def backfit_gev(raw, maps, l_freq=1., h_freq=30., chunk_size=10000,
+                scaling=None, verbose=None):
+    """Compute the GEV of maps on a whole recording, block by block.
+
+    The recording is preprocessed like in :func:`collect_peaks`, and the
+    maps are back-fitted to all its samples, as with
+    :func:`microstates.backfit`. This gives the GEV of maps fitted on the
+    collected peaks over the whole recording.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        The recording. It does not need to be preloaded.
+    maps : ndarray, shape (n_states, n_channels)
+        The topographic maps of the microstates.
+    l_freq : float | None
+        The low cut-off frequency of the band-pass filter. Defaults to 1.
+    h_freq : float | None
+        The high cut-off frequency of the band-pass filter. Defaults to 30.
+    chunk_size : int
+        The number of samples to read at a time. Defaults to 10000.
+    scaling : tuple of ndarray | None
+        The mean and standard deviation of each channel to normalize the
+        data with, as returned by :func:`collect_peaks`. Defaults to
+        ``None``, in which case the data is not normalized.
+    verbose : int | bool | None
+        Controls the verbosity.
+
+    Returns
+    -------
+    gev : float
+        The global explained variance of the maps.
+    """
+    templates = normalize_templates(maps)
+    gev_sum = gfp_sum_sq = 0
+    for block in _preprocessed_blocks(raw, l_freq, h_freq, chunk_size,
+                                      scaling):
+        _, map_corr = match_templates(block, templates)
+        gfp = _gfp(block)
+        gev_sum += np.sum((gfp * map_corr) ** 2)
+        gfp_sum_sq += np.sum(gfp ** 2)
+    gev = gev_sum / gfp_sum_sq
+    logger.info('GEV on the whole recording: %f' % gev)
+    return gev
+
+
+def _preprocessed_blocks(raw, l_freq, h_freq, chunk_size, scaling=None):
+    """Read a recording in blocks, filtered and re-referenced.
+
+    Each pass uses a new filter, so every pass gives the same blocks. When
+    ``scaling`` is given, the blocks are also normalized with it.
+    """
+    bandpass = BandpassFilter(l_freq, h_freq, raw.info['sfreq'])
+    for start in range(0, raw.n_times, chunk_size):
+        block = raw.get_data(start=start,
+                             stop=min(start + chunk_size, raw.n_times))
+        block = bandpass.process(block)
+        block -= np.mean(block, axis=0, keepdims=True)  # Average reference
+        if scaling is not None:
+            mean, std = scaling
+            block = (block - mean[:, np.newaxis]) / std[:, np.newaxis]
+        yield block
+
+
+class RingBuffer(object):
+    """Circular buffer holding the most recent samples of a stream.
+
+    Parameters
+    ----------
+    n_channels : int
+        The number of channels.
+    size : int
+        The number of samples to hold.
+
+    Attributes
+    ----------
+    n_samples : int
+        The total number of samples written to the buffer so far.
+    """
+    def __init__(self, n_channels, size):
+        self.size = size
+        self.n_samples = 0
+        self._data = np.zeros((n_channels, size))
+
+    def extend(self, samples):
+        """Append samples to the buffer, overwriting the oldest ones.
+
+        Parameters
+        ----------
+        samples : ndarray, shape (n_channels, n_samples)
+            The new samples.
+        """
+        n_new = samples.shape[1]
+        kept = samples[:, -self.size:]
+        start = self.n_samples + n_new - kept.shape[1]
+        self._data[:, _ring_index(start, start + kept.shape[1],
+                                  self.size)] = kept
+        self.n_samples += n_new
+
+    def latest(self, n):
+        """Get the most recent samples, in chronological order.
+
+        Parameters
+        ----------
+        n : int
+            The number of samples to get. At most ``size`` samples can be
+            retrieved.
+
+        Returns
+        -------
+        samples : ndarray, shape (n_channels, n)
+            The samples.
+        """
+        n = min(n, self.size, self.n_samples)
+        return self._data[:, _ring_index(self.n_samples - n, self.n_samples,
+                                         self.size)]
+
+
+def _ring_index(start, stop, size):
+    """Positions in a ring buffer of the absolute samples [start, stop)."""
+    return np.arange(start, stop) % size
+
+
+class OnlineSegmenter(object):
+    """Incremental microstate labelling of a stream of samples.
+
+    Incoming samples are appended to a ring buffer spanning the feedback
+    window. Only the samples that are new since the previous update are passed
+    to a :class:`GFPPeakDetector`. The confirmed peaks are matched to the
+    templates with :func:`microstates.match_templates`, as in offline
+    back-fitting, and the samples between the midpoints to the neighbouring
+    peaks are labelled with its microstate. The number of samples in the window
+    labelled with the target microstate is updated as samples enter and leave
+    the window, so the cost of an update only depends on the number of new
+    samples.
+
+    Parameters
+    ----------
+    templates : ndarray, shape (n_states, n_channels)
+        The topographic maps of the microstates.
+    window_size : int
+        The length of the feedback window in samples.
+    target : int
+        The index of the microstate to regulate.
+    min_peak_dist : int
+        Minimum distance (in samples) between peaks in the GFP. Defaults to 2.
+    lookahead : int | None
+        The number of samples to wait after a peak before confirming it. See
+        :class:`GFPPeakDetector`. Defaults to ``None``, in which case
+        ``3 * min_peak_dist`` is used.
+    monitor : instance of LatencyMonitor | None
+        If given, the stages of each update are timed with it: ``'buffer'``,
+        ``'gfp'``, ``'peaks'``, ``'match'`` and ``'label'``. Defaults to
+        ``None``.
+    stats : instance of OnlineStats | None
+        If given, the labels are passed to it as they are decided, to keep
+        track of the duration, occurrence and transitions of the
+        microstates. Defaults to ``None``.
+    min_segment_length : int | None
+        Segments shorter than this many samples are reassigned to their
+        neighbours, as with :func:`microstates.reject_short_segments`: the
+        first half to the previous segment and the second half to the next
+        one. This is done causally: the labels of a short segment are held
+        back until the next segment is decided, or until it has grown long
+        enough. Defaults to ``None``.
+
+    Attributes
+    ----------
+    last_ts : float
+        The timestamp of the most recent sample.
+    """
+    def __init__(self, templates, window_size, target, min_peak_dist=2,
+                 lookahead=None, monitor=None, stats=None,
+                 min_segment_length=None):
+        self.templates = normalize_templates(templates)
+        self.window_size = window_size
+        self.target = target
+        self.monitor = monitor
+        self.stats = stats
+        self.min_segment_length = min_segment_length
+        self.last_ts = -np.inf
+        self.buffer = RingBuffer(templates.shape[1], window_size)
+        self.detector = GFPPeakDetector(min_peak_dist, lookahead, monitor)
+
+        # The microstate label of each sample in the window, -1 when not
+        # labelled (yet), and the number of samples labelled as target.
+        self._labels = np.full(window_size, -1)
+        self._count = 0
+
+        # The last peak found, which labels the samples up to the midpoint
+        # to the next peak, and the first sample without a label.
+        self._prev_peak = None
+        self._labeled_until = 0
+
+        # The segment that is held back as it may be too short, as (start,
+        # stop, label), and the label of the last segment given out.
+        self._pending = None
+        self._last_label = None
+
+    @property
+    def percent(self):
+        """Percentage of the window labelled as the target microstate."""
+        n_samples = min(self.buffer.n_samples, self.window_size)
+        if n_samples == 0:
+            return 0.
+        return self._count / n_samples * 100
+
+    @property
+    def labels(self):
+        """The label of each sample in the window, in chronological order.
+
+        Samples that are not labelled yet, as they come after the last
+        confirmed peak, have label -1.
+        """
+        n_samples = min(self.buffer.n_samples, self.window_size)
+        return self._labels[_ring_index(self.buffer.n_samples - n_samples,
+                                        self.buffer.n_samples,
+                                        self.window_size)]
+
+    def update(self, samples, timestamps):
+        """Process the samples that are newer than the previous update.
+
+        Parameters
+        ----------
+        samples : ndarray, shape (n_channels, n_samples)
+            A chunk of samples from the stream. It may overlap with the
+            samples of the previous update.
+        timestamps : array-like, shape (n_samples,)
+            The timestamp of each sample.
+
+        Returns
+        -------
+        n_new : int
+            The number of new samples.
+        """
+        timestamps = np.asarray(timestamps)
+        new = timestamps > self.last_ts
+        n_new = np.sum(new)
+        if n_new == 0:
+            return 0
+        samples = samples[:, new]
+        self.last_ts = timestamps[new][-1]
+
+        # The new samples replace the oldest ones in the window
+        start = self.buffer.n_samples
+        self._relabel(start, start + n_new, -1)
+        self.buffer.extend(samples)
+        if self.monitor is not None:
+            self.monitor.mark('buffer')
+
+        peaks, topographies = self.detector.update(samples)
+        labels, _ = match_templates(topographies, self.templates)
+        if self.monitor is not None:
+            self.monitor.mark('match')
+        for peak, label in zip(peaks, labels):
+            self._add_peak(peak, label)
+        if self.monitor is not None:
+            self.monitor.mark('label')
+        return n_new
+
+    def _add_peak(self, index, label):
+        """Label the samples up to a new peak."""
+        if self._prev_peak is None:
+            self._labeled_until = index
+        else:
+            prev_index, prev_label = self._prev_peak
+            midpoint = (prev_index + index) // 2
+            self._decide(self._labeled_until, midpoint, prev_label)
+            self._labeled_until = midpoint
+        self._prev_peak = (index, label)
+
+    def _decide(self, start, stop, label):
+        """Handle the samples [start, stop), whose label is decided."""
+        if self.min_segment_length is None:
+            self._emit(start, stop, label)
+            return
+
+        if self._pending is not None:
+            pending_start, _, pending_label = self._pending
+            self._pending = None
+            if label == pending_label or self._last_label is None:
+                # The pending segment continues, or has no previous segment
+                start = pending_start
+            else:
+                # The pending segment is too short: split it
+                middle = pending_start + (start - pending_start) // 2
+                self._emit(pending_start, middle, self._last_label)
+                start = middle
+
+        if stop - start >= self.min_segment_length or \
+                label == self._last_label:
+            self._emit(start, stop, label)
+        else:
+            self._pending = (start, stop, label)
+
+    def _emit(self, start, stop, label):
+        """Give out the final label of the samples [start, stop)."""
+        if start >= stop:
+            return
+        self._relabel(max(start, self.buffer.n_samples - self.window_size),
+                      stop, label)
+        if self.stats is not None:
+            self.stats.update(np.full(stop - start, label))
+        self._last_label = label
+
+    def _relabel(self, start, stop, label):
+        """Set the label of the samples [start, stop) in the window."""
+        start = max(start, stop - self.window_size)
+        if start >= stop:
+            return
+        idx = _ring_index(start, stop, self.window_size)
+        self._count -= np.sum(self._labels[idx] == self.target)
+        self._labels[idx] = label
+        if label == self.target:
+            self._count += stop - start
@@ -0,0 +1,163 @@
+"""
+Storage of microstate templates, together with the settings of the
+recording they were fitted on.
+
+Templates are stored in a binary ``.npz`` file holding the maps, the channel
+names, the sampling rate, the band-pass filter, the scaling of the channels
+when the training data was normalized and the global explained variance
+(GEV) of the fit. The online protocol loads them once at startup,
+checks the channels of the stream against them and keeps the normalized
+maps in memory.
+"""
+import os
+import numpy as np
+from mne.utils import logger
+
+from microstates import normalize_templates
+
+
+class Templates(object):
+    """Microstate templates and the settings they were fitted with.
+
+    Parameters
+    ----------
+    maps : ndarray, shape (n_states, n_channels)
+        The topographic maps of the microstates.
+    ch_names : list of str | None
+        The name of the channel of each column of the maps.
+    sfreq : float | None
+        The sampling frequency of the training data in Hz.
+    l_freq : float | None
+        The low cut-off frequency of the filter applied to the training data.
+    h_freq : float | None
+        The high cut-off frequency of the filter applied to the training data.
+    gev : float | None
+        The global explained variance of the maps on the training data.
+    scaling : tuple of ndarray | None
+        The mean and standard deviation of each channel that the training
+        data was normalized (z-scored) with before fitting, each of shape
+        (n_channels,). ``None`` when the data was not normalized.
+
+    Attributes
+    ----------
+    normalized : ndarray, shape (n_states, n_channels)
+        The maps centered and scaled to unit norm, ready for use with
+        :func:`microstates.match_templates`.
+    """
+    def __init__(self, maps, ch_names=None, sfreq=None, l_freq=None,
+                 h_freq=None, gev=None, scaling=None):
+        self.maps = np.asarray(maps, dtype=float)
+        if ch_names is not None:
+            ch_names = list(ch_names)
+            if len(ch_names) != self.maps.shape[1]:
+                raise ValueError('The templates have %d channels, but %d '
+                                 'channel names were given.' %
+                                 (self.maps.shape[1], len(ch_names)))
+        self.ch_names = ch_names
+        if scaling is not None:
+            scaling = tuple(np.asarray(x, dtype=float) for x in scaling)
+            if len(scaling) != 2 or any(x.shape != (self.maps.shape[1],)
+                                        for x in scaling):
+                raise ValueError('The scaling must be the mean and standard '
+                                 'deviation of each of the %d channels.' %
+                                 self.maps.shape[1])
+        self.scaling = scaling
+        self.sfreq = sfreq
+        self.l_freq = l_freq
+        self.h_freq = h_freq
+        self.gev = gev
+        self.normalized = normalize_templates(self.maps)
+
+    @property
+    def n_states(self):
+        """The number of microstates."""
+        return self.maps.shape[0]
+
+    def __repr__(self):
+        return '<Templates | %d states, %d channels>' % self.maps.shape
+
+    def get_picks(self, ch_names):
+        """Find the channels of the templates in a list of channel names.
+
+        Parameters
+        ----------
+        ch_names : list of str
+            The channel names, for example those of the live stream.
+
+        Returns
+        -------
+        picks : ndarray of int, shape (n_channels,)
+            For each channel of the templates, its index in ``ch_names``.
+            Indexing the data with it puts the channels in the order of the
+            templates.
+        """
+        if self.ch_names is None:
+            raise ValueError('The templates do not contain channel names.')
+        ch_names = list(ch_names)
+        missing = [ch for ch in self.ch_names if ch not in ch_names]
+        if missing:
+            raise ValueError('Channels of the templates are missing from the '
+                             'data: %s' % ', '.join(missing))
+        picks = np.array([ch_names.index(ch) for ch in self.ch_names])
+        if not np.array_equal(picks, np.arange(len(picks))):
+            logger.info('Reordering the channels to match the templates.')
+        return picks
+
+    def save(self, fname):
+        """Save the templates to a binary .npz file.
+
+        Parameters
+        ----------
+        fname : str
+            The name of the file. The ``.npz`` extension is added if needed.
+        """
+        ch_names = [] if self.ch_names is None else self.ch_names
+        if self.scaling is None:
+            scaling = np.empty((0, self.maps.shape[1]))
+        else:
+            scaling = np.array(self.scaling)
+        np.savez(fname, maps=self.maps, ch_names=np.array(ch_names, dtype=str),
+                 sfreq=_to_float(self.sfreq), l_freq=_to_float(self.l_freq),
+                 h_freq=_to_float(self.h_freq), gev=_to_float(self.gev),
+                 scaling=scaling, n_states=self.n_states)
+
+
+def read_templates(fname):
+    """Read microstate templates.
+
+    Parameters
+    ----------
+    fname : str
+        The ``.npz`` file written by :meth:`Templates.save`. For backwards
+        compatibility, a text file written with ``np.savetxt`` can be read as
+        well, but then no channel names or other settings are available.
+
+    Returns
+    -------
+    templates : instance of Templates
+        The templates.
+    """
+    if os.path.splitext(fname)[1] != '.npz':
+        logger.warning('Reading templates from a text file, which does not '
+                       'contain the channel names.')
+        return Templates(np.loadtxt(fname, dtype=float, ndmin=2))
+
+    with np.load(fname, allow_pickle=False) as f:
+        ch_names = [str(ch) for ch in f['ch_names']] or None
+        # Files written before the scaling was stored have none
+        scaling = f['scaling'] if 'scaling' in f.files else []
+        scaling = tuple(scaling) if len(scaling) > 0 else None
+        return Templates(f['maps'], ch_names, _from_float(f['sfreq']),
+                         _from_float(f['l_freq']), _from_float(f['h_freq']),
+                         _from_float(f['gev']), scaling)
+
+
+def _to_float(value):
+    """Store an optional number, using NaN for None."""
+    return np.nan if value is None else float(value)
+
+
+def _from_float(value):
+    """Read an optional number, using None for NaN."""
+    value = float(value)
+    return None if np.isnan(value) else value
@@ -17,6 +17,9 @@ import multiprocessing as mp
 from importlib import import_module
 import mne
 import microstates
+import streaming
+from templates import Templates
+from session import session_control
 
 import pycnbi.decoder.features as features
 
@@ -36,6 +39,15 @@ def check_config(cfg):
         'COMMON': ['DATA_PATH'],
     }
     optional_vars = {
+        'NJOBS': 1,
+        'STREAMING': False,
+        'CHUNK_SIZE': 10000,
+        'MAX_N_PEAKS': 10000000,
+        'N_STATES': 4,
+        'N_COMPONENTS': None,
+        'METHOD': 'kmeans',
+        'INIT': 'random',
+        'PRUNE': None,
     }
     
     for key in critical_vars['COMMON']:
@@ -50,21 +62,47 @@ def check_config(cfg):
     
     return cfg
 
+#----------------------------------------------------------------------
+def select_templates(cfg, data, fit_params):
+    """
+    Fit the microstates for each number of states in cfg.N_STATES, sharing the
+    peak extraction, and keep the number of states with the best
+    Krzanowski-Lai criterion (or the lowest cross-validation criterion if it
+    cannot be computed).
+
+    Returns the maps and their GEV on all the data.
+    """
+    all_maps, scores = microstates.select_n_states(data, n_states=cfg.N_STATES, n_jobs=cfg.NJOBS, **fit_params)
+    for i, k in enumerate(scores['n_states']):
+        logger.info('%d states: GEV %.3f, CV %.4f, KL %.3f, silhouette %.3f' %
+                    (k, scores['gev'][i], scores['cv'][i], scores['kl'][i], scores['silhouette'][i]))
+
+    if np.all(np.isnan(scores['kl'])):
+        n_states = scores['n_states'][np.nanargmin(scores['cv'])]
+    else:
+        n_states = scores['n_states'][np.nanargmax(scores['kl'])]
+    logger.info('Keeping %d states' % n_states)
+
+    maps = all_maps[n_states]
+    _, gev = microstates.backfit(data, maps)
+    return maps, gev
+
 #----------------------------------------------------------------------
 def run(cfg, state=mp.Value('i', 1), queue=None):
     """
     Training protocol for Alpha/Theta neurofeedback.
     """
     redirect_stdout_to_queue(logger, queue, 'INFO')
+    session = session_control(state)
 
     # add tdef object
     cfg.tdef = trigger_def(cfg.TRIGGER_FILE)
 
     # Extract features
-    if not state.value:
+    if not session.wait_for_start():
         sys.exit(-1)
 
-    raw = mne.io.read_raw_brainvision(cfg.DATA_PATH, preload=True)
+    raw = mne.io.read_raw_brainvision(cfg.DATA_PATH, preload=not cfg.STREAMING)
     outfile = cfg.OUT_MICROSTATES_FILE
 
     ch_names = ['P3', 'C3', 'F3', 'Fz', 'F4', 'C4', 'P4', 'Cz', 'Pz', 'Fp1', 'Fp2', 'T3', 'T5', 'O1', 'O2', 'F7', 'F8',
@@ -72,11 +110,38 @@ def run(cfg, state=mp.Value('i', 1), queue=None):
     raw.pick_channels(ch_names)
 
     raw.set_montage('standard_1005')
-    raw.set_eeg_reference('average')
-    raw.filter(1, 30)
-    maps, segmentation = microstates.segment(raw.get_data(), n_states=4, max_n_peaks=10000000, max_iter=5000,
-                                             normalize=True)
-    np.savetxt(outfile, maps, delimiter=" ")
+
+    l_freq, h_freq = 1, 30
+    if cfg.STREAMING:
+        # Read the file block by block and keep only the GFP peaks
+        data, scaling = streaming.collect_peaks(raw, l_freq, h_freq, chunk_size=cfg.CHUNK_SIZE,
+                                                max_n_peaks=cfg.MAX_N_PEAKS, normalize=True,
+                                                return_scaling=True)
+        fit_params = dict(max_iter=5000, use_peaks=False, n_components=cfg.N_COMPONENTS, method=cfg.METHOD,
+                          init=cfg.INIT, prune=cfg.PRUNE)
+    else:
+        raw.set_eeg_reference('average')
+        raw.filter(l_freq, h_freq)
+        data = raw.get_data()
+        # Normalize each channel here rather than in segment, to store the scaling with the templates
+        scaling = (np.mean(data, axis=1), np.std(data, axis=1))
+        data = (data - scaling[0][:, np.newaxis]) / scaling[1][:, np.newaxis]
+        fit_params = dict(max_n_peaks=cfg.MAX_N_PEAKS, max_iter=5000, n_components=cfg.N_COMPONENTS,
+                          method=cfg.METHOD, init=cfg.INIT, prune=cfg.PRUNE)
+
+    if np.isscalar(cfg.N_STATES):
+        maps, segmentation, gev = microstates.segment(data, n_states=cfg.N_STATES, n_jobs=cfg.NJOBS,
+                                                      return_gev=True, **fit_params)
+    else:
+        # Choose the number of states
+        maps, gev = select_templates(cfg, data, fit_params)
+
+    if cfg.STREAMING:
+        # The GEV above is on the collected peaks. Store the GEV on the whole recording, as in memory.
+        gev = streaming.backfit_gev(raw, maps, l_freq, h_freq, chunk_size=cfg.CHUNK_SIZE, scaling=scaling)
+
+    templates = Templates(maps, raw.ch_names, raw.info['sfreq'], l_freq, h_freq, gev, scaling)
+    templates.save(outfile)
     #----------------------------------------------------------------------        
     # ADD YOUR CODE HERE
     #----------------------------------------------------------------------